@@ -1,7 +1,12 @@
 import os
 import sys
+import json
+import time
+import queue
+import shutil
 import platform
-from enum import Enum
+import threading
+from enum import Enum, IntEnum
 
 _win32_legacy_con = False
 _win32_handle = None
@@ -48,6 +53,13 @@ class Severity(Enum):
     ERROR = Color.RED
 
 
+class Level(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
 WARNING_COUNT = 0
 
 
@@ -59,19 +71,266 @@ def warning(*text):
 
 def error(*text):
     _print_severity(Severity.ERROR, "\n        ", *text, "\n")
+    flush_logging()
     quit(1)
 
 
 def verbose(*text):
-    print("".join(text))
+    log(Level.DEBUG, "".join(text))
 
 
 def verbose_color(color: Color, *text):
-    print_color(color, "".join(text))
+    log(Level.DEBUG, "".join(text), color)
 
 
 def _print_severity(level: Severity, spacing: str, *text):
-    print_color(level.value, f"[{level.name}] {spacing.join(text)}")
+    log(Level[level.name], f"[{level.name}] {spacing.join(text)}", level.value)
+
+
+# ==================================================================================================
+# Log Backend
+# ==================================================================================================
+# everything printed goes through one writer thread once setup_logging is called, so parallel jobs don't
+# block on the console or write over each other, and every line can also go to log files
+
+
+class LogRecord:
+    def __init__(self, level: Level, text: str, color: Color = None, raw: bool = False, status: bool = False):
+        self.time = time.time()
+        self.level = level
+        self.text = text
+        self.color = color
+        self.raw = raw  # written to the console as is, no newline, timestamp, or file output
+        self.status = status  # replaces the status lines under the log
+        self.job = getattr(_log_local, "job", "")
+
+
+class _LogState:
+    def __init__(self):
+        self.started = False
+        self.level = Level.INFO
+        self.timestamps = False
+        self.folder = ""
+        self.logFile = None
+        self.jsonFile = None
+        self.jobFiles = {}
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = None
+        self.status = []
+        self.statusDrawn = 0
+
+
+_log = _LogState()
+_log_local = threading.local()
+_stdout = sys.stdout
+
+
+# anything print()'ed ends up here once logging is set up, one record per line
+class _LogStream:
+    def __init__(self):
+        self.local = threading.local()
+
+    def write(self, text: str):
+        buffer = getattr(self.local, "buffer", "") + text
+        *lines, self.local.buffer = buffer.split("\n")
+        for line in lines:
+            log(Level.INFO, line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self) -> bool:
+        return _stdout.isatty()
+
+    @property
+    def encoding(self):
+        return _stdout.encoding
+
+
+# folder gets a replay_maker.log with everything, and a log for each job in jobs/,
+# jsonPath gets every record as a line of json
+def setup_logging(level: Level = Level.INFO, folder: str = "", jsonPath: str = "", timestamps: bool = False):
+    if _log.started:
+        return
+
+    _log.level = level
+    _log.timestamps = timestamps
+    _log.folder = folder
+
+    if folder:
+        os.makedirs(os.path.join(folder, "jobs"), exist_ok=True)
+        _log.logFile = open(os.path.join(folder, "replay_maker.log"), mode="a", encoding="utf-8")
+
+    if jsonPath:
+        _log.jsonFile = open(jsonPath, mode="a", encoding="utf-8")
+
+    _log.thread = threading.Thread(target=_log_writer, name="log writer")
+    _log.thread.daemon = True
+    _log.thread.start()
+    _log.started = True
+
+    sys.stdout = _LogStream()
+
+
+# records from this thread go to this job's log file too, threads started for a job have to set it again
+def set_log_job(name: str):
+    _log_local.job = name
+
+
+def get_log_job() -> str:
+    return getattr(_log_local, "job", "")
+
+
+# lines kept at the bottom of the console under everything else, redrawn whenever they change or something is logged.
+# only works on a real console with ansi codes, can_show_status says if it will
+def set_status(lines):
+    if _log.started:
+        _log.queue.put(LogRecord(Level.INFO, "\n".join(lines), raw=True, status=True))
+
+
+def can_show_status() -> bool:
+    return _stdout.isatty() and not _win32_legacy_con
+
+
+def log(level: Level, text: str, color: Color = None):
+    record = LogRecord(level, text, color)
+
+    if not _log.started:
+        if level >= Level.INFO:
+            _write_console(record)
+        return
+
+    _log.queue.put(record)
+
+
+# waits for everything logged so far to be written
+def flush_logging():
+    if _log.started:
+        _log.queue.join()
+    _stdout.flush()
+
+
+def shutdown_logging():
+    if not _log.started:
+        return
+
+    flush_logging()
+    _log.queue.put(None)
+    _log.thread.join()
+    _log.started = False
+    sys.stdout = _stdout
+
+    for file in [_log.logFile, _log.jsonFile, *_log.jobFiles.values()]:
+        if file is not None:
+            file.close()
+
+
+def _log_writer():
+    while True:
+        record = _log.queue.get()
+
+        try:
+            if record is None:
+                return
+            _write_record(record)
+        except Exception as F:
+            _stdout.write(f"[ERROR] failed writing log record: {F}\n")
+        finally:
+            _log.queue.task_done()
+
+
+def _format_line(record: LogRecord) -> str:
+    stamp = time.strftime("%H:%M:%S", time.localtime(record.time)) + f".{int(record.time * 1000) % 1000:03}"
+    job = f" [{record.job}]" if record.job else ""
+    return f"{stamp} {record.level.name:<7}{job} {record.text}\n"
+
+
+def _write_record(record: LogRecord):
+    if record.status:
+        _clear_status()
+        _log.status = record.text.split("\n") if record.text else []
+        _draw_status()
+        _stdout.flush()
+        return
+
+    if record.level >= _log.level:
+        _write_console(record)
+
+    if record.raw:
+        return
+
+    if _log.logFile is not None:
+        _log.logFile.write(_format_line(record))
+
+    if _log.folder and record.job:
+        jobFile = _log.jobFiles.get(record.job)
+        if jobFile is None:
+            jobFile = open(os.path.join(_log.folder, "jobs", record.job + ".log"), mode="a", encoding="utf-8")
+            _log.jobFiles[record.job] = jobFile
+        jobFile.write(_format_line(record))
+
+    if _log.jsonFile is not None:
+        _log.jsonFile.write(json.dumps({
+            "time": record.time,
+            "level": record.level.name,
+            "job": record.job,
+            "message": record.text,
+        }) + "\n")
+
+    # don't leave the files behind by much if we get killed
+    if _log.queue.empty():
+        for file in [_log.logFile, _log.jsonFile, *_log.jobFiles.values()]:
+            if file is not None:
+                file.flush()
+
+
+def _write_console(record: LogRecord):
+    text = record.text
+    if not record.raw:
+        if _log.timestamps:
+            text = time.strftime("[%H:%M:%S] ", time.localtime(record.time)) + text
+        text += "\n"
+
+    _clear_status()
+
+    if record.color is None:
+        _stdout.write(text)
+    elif _win32_legacy_con:
+        win32_set_fore_color(int(record.color.value))
+        _stdout.write(text)
+        win32_set_fore_color(int(Color.DEFAULT.value))
+    else:
+        _stdout.write(record.color.value + text + Color.DEFAULT.value)
+
+    _draw_status()
+    _stdout.flush()
+
+
+def _clear_status():
+    if _log.statusDrawn:
+        # back to the first status line, and clear everything below it
+        _stdout.write(f"\033[{_log.statusDrawn}F\033[J")
+        _log.statusDrawn = 0
+
+
+def _draw_status():
+    if not _log.status:
+        return
+
+    # lines that wrap would throw off how far up to go when clearing them
+    width = shutil.get_terminal_size().columns - 1
+    for line in _log.status:
+        _stdout.write(line[:width] + "\n")
+    _log.statusDrawn = len(_log.status)
+
+
+def _write_console_raw(color: Color, text: str):
+    record = LogRecord(Level.INFO, text, color, raw=True)
+    if _log.started:
+        _log.queue.put(record)
+    else:
+        _write_console(record)
 
 
 def win32_set_fore_color(color: int):
@@ -81,21 +340,19 @@ def win32_set_fore_color(color: int):
 
 
 def stdout_color(color: Color, *text):
-    if _win32_legacy_con:
-        win32_set_fore_color(int(color.value))
-        sys.stdout.write("".join(text))
-        win32_set_fore_color(int(Color.DEFAULT.value))
-    else:
-        sys.stdout.write(color.value + "".join(text) + Color.DEFAULT.value)
+    _write_console_raw(color, "".join(text))
 
 
 def print_color(color: Color, *text):
-    stdout_color(color, *text, "\n")
+    log(Level.INFO, "".join(text), color)
 
 
 def set_con_color(color: Color):
     if _win32_legacy_con:
+        # has to happen in order with everything else being written
+        _write_console_raw(None, "")
+        flush_logging()
         win32_set_fore_color(int(color.value))
     else:
-        sys.stdout.write(color.value)
+        _write_console_raw(None, color.value)
 
@@ -1,12 +1,18 @@
 import os
 import sys
+import stat
 import shutil
 import psutil
+import select
+import ctypes
 import subprocess
+import copy
 import hashlib
 import threading
 import argparse
 import traceback
+import collections
+import concurrent.futures
 from typing import List, Dict, Tuple
 import time
 
@@ -15,6 +21,9 @@ from datetime import datetime, timedelta
 import demez_key_values as lexer
 from video_player import VideoPlayer
 from replay_logging import *
+from replay_resources import *
+from replay_profiler import PROFILER, profiled
+from replay_metrics import METRICS
 
 
 if os.name == "nt":
@@ -24,6 +33,7 @@ if os.name == "nt":
 # TEMP_FOLDER = ("TEMP" + os.sep + str(datetime.now()) + os.sep).replace(":", "-").replace(".", "-")
 ROOT_FOLDER = f"{os.path.dirname(os.path.realpath(__file__))}{os.sep}"
 TEMP_FOLDER = f"{ROOT_FOLDER}TEMP{os.sep}"
+CACHE_FOLDER = f"{ROOT_FOLDER}cache{os.sep}"
 
 cmd_bar_line = "-----------------------------------------------------------"
 
@@ -37,12 +47,74 @@ def parse_args() -> argparse.Namespace:
     arg_parser.add_argument("-e", "--encode", action="store_true")
     arg_parser.add_argument("-2", "--encode-2pass", action="store_true")
     arg_parser.add_argument("-r", "--encode-raw", action="store_true")
+    arg_parser.add_argument("-b", "--encode-both", action="store_true",
+                            help="encode normal and raw outputs in one run, reading each time range once")
     arg_parser.add_argument("-m", "--move-files", action="store_true")
     arg_parser.add_argument("-k", "--keep-temp", action="store_true")
     arg_parser.add_argument("--high", action="store_true", help="high priority")
     arg_parser.add_argument("--below-normal", action="store_true", help="below normal priority")
+    arg_parser.add_argument("--idle", action="store_true", help="idle priority")
+    arg_parser.add_argument("--nice", type=int, help="nice value for ffmpeg on linux and mac, overrides the priority")
+    arg_parser.add_argument("--io-class", choices=IO_CLASSES, help="io scheduling class for ffmpeg on linux")
+    arg_parser.add_argument("--cpu-limit", type=float, default=0,
+                            help="cgroup cpu limit for each ffmpeg process in percent of one cpu, linux only")
+    arg_parser.add_argument("--memory-limit", type=int, default=0,
+                            help="cgroup memory limit for each ffmpeg process in MB, linux only")
     arg_parser.add_argument("--raw-ffmpeg", action="store_true")
-    arg_parser.add_argument("-c", "--cpus", nargs=2, help="cpu affinity range", default=[0, 8])
+    arg_parser.add_argument("--raw-pipes", action="store_true",
+                            help="stream raw clips into the final video through named pipes instead of temp files, "
+                                 "not on windows")
+    arg_parser.add_argument("--no-merge-ranges", action="store_true", help="don't merge back to back time ranges")
+    arg_parser.add_argument("--scene-index", action="store_true",
+                            help="find scene changes in every input in the background, used for chunks and bitrates")
+    arg_parser.add_argument("--scene-threshold", type=float, default=0.3, help="scene change score from 0 to 1")
+    arg_parser.add_argument("--scene-workers", type=int, default=2, help="how many inputs to index at once")
+    arg_parser.add_argument("--snap-to-scenes", type=float, default=0,
+                            help="move timestamps to the closest scene change within this many seconds")
+    arg_parser.add_argument("--chunk-length", type=float, default=0,
+                            help="split time ranges over twice this long (in seconds) into chunks encoded in parallel")
+    arg_parser.add_argument("--chunk-workers", type=int, default=4, help="how many chunks to encode at once")
+    arg_parser.add_argument("--no-early-abort", action="store_true",
+                            help="let every size loop attempt finish, even if it's clearly going to miss")
+    arg_parser.add_argument("--no-split-audio", action="store_true",
+                            help="encode audio with every size retry instead of once per time range")
+    arg_parser.add_argument("-c", "--cpus", nargs=2, help="cpu affinity range, defaults to every cpu we're allowed to use")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1, help="how many output videos to encode at once")
+    arg_parser.add_argument("--order", default="config", choices=["config", "longest", "source", "balanced"],
+                            help="order to start encoding output videos in: config file order, longest first, "
+                                 "grouped by input video, or grouped by input video with the longest groups first")
+    arg_parser.add_argument("--max-load", type=float, default=1.5,
+                            help="hold back jobs while the load average per cpu would go over this, 0 to disable")
+    arg_parser.add_argument("--min-free-memory", type=int, default=1024,
+                            help="hold back jobs that would leave less than this many MB of memory free")
+    arg_parser.add_argument("--min-free-disk", type=int, default=2048,
+                            help="hold back jobs that would leave less than this many MB free in the temp folders")
+    arg_parser.add_argument("--prefetch", type=int, default=0,
+                            help="read up to this many MB of the inputs for upcoming jobs ahead of time, "
+                                 "for inputs on slow or network drives")
+    arg_parser.add_argument("--no-verify", action="store_true",
+                            help="don't check clips can be combined, or that the output videos came out right")
+    arg_parser.add_argument("--verify-workers", type=int, default=2, help="how many outputs to check at once")
+    arg_parser.add_argument("--verify-retries", type=int, default=1,
+                            help="how many times to redo an output video that failed the check")
+    arg_parser.add_argument("--profile", nargs="?", const=f"{ROOT_FOLDER}profile.json",
+                            help="time each stage of the run, and write a chrome trace to this file "
+                                 "(profile.json by default)")
+    arg_parser.add_argument("--dashboard", action="store_true",
+                            help="show live stats for every running ffmpeg under the log, on by default with -j")
+    arg_parser.add_argument("--no-dashboard", action="store_true")
+    arg_parser.add_argument("-w", "--watch", action="store_true",
+                            help="keep running, and encode outputs again whenever their part of the config changes")
+    arg_parser.add_argument("--metrics", help="keep prometheus metrics in this file, for node_exporter's textfile "
+                                              "collector, the file name has to end in .prom")
+    arg_parser.add_argument("--metrics-port", type=int, default=0, help="serve prometheus metrics on this localhost port")
+    arg_parser.add_argument("--log-dir", help="write a log of everything here, and one for each job, "
+                                               "ffmpeg's output goes in them instead of the console")
+    arg_parser.add_argument("--log-json", help="write every log line to this file as json")
+    arg_parser.add_argument("--log-timestamps", action="store_true", help="show the time on every console line")
+    arg_parser.add_argument("-t", "--temp-dir", action="append",
+                            help="folder for temp files, ideally on a fast local disk, can be given more than once "
+                                 "to fall back to the next one when one fills up")
     return arg_parser.parse_args()
 
 
@@ -107,12 +179,224 @@ def calc_bpp(rate: float, width: float, height: float, fps: float):
     return rate / (width * height * fps)
 
 
+# ==================================================================================================
+# Metrics
+# ==================================================================================================
+
+
+METRIC_JOBS = METRICS.counter("replay_maker_jobs_total", "Output videos finished, by result")
+METRIC_ENCODE_SECONDS = METRICS.histogram("replay_maker_encode_seconds", "Time taken to encode an output video",
+                                          [10, 30, 60, 120, 300, 600, 1200, 2400, 3600])
+METRIC_SPEED = METRICS.histogram("replay_maker_speed_factor", "Seconds of video encoded per second of encoding",
+                                 [0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10])
+METRIC_READ_BYTES = METRICS.counter("replay_maker_read_bytes_total", "Bytes read by ffmpeg")
+METRIC_WRITTEN_BYTES = METRICS.counter("replay_maker_written_bytes_total", "Bytes written by ffmpeg")
+METRIC_SIZE_ATTEMPTS = METRICS.histogram("replay_maker_size_loop_attempts",
+                                         "Encode attempts it took an input to land in the size window",
+                                         [1, 2, 3, 4, 5, 6, 8, 10])
+METRIC_PROBE_CACHE = METRICS.counter("replay_maker_probe_cache_total", "Source probe cache lookups, by result")
+METRIC_PROBE_HIT_RATIO = METRICS.gauge("replay_maker_probe_cache_hit_ratio", "Source probe cache hits over lookups")
+METRIC_SCRATCH_RESERVED = METRICS.gauge("replay_maker_scratch_reserved_bytes",
+                                        "Space running jobs are still expected to write in each temp folder")
+METRIC_SCRATCH_FREE = METRICS.gauge("replay_maker_scratch_free_bytes",
+                                    "Space left in each temp folder after reservations")
+
+
+def collect_metrics():
+    lookups = METRIC_PROBE_CACHE.get_total()
+    METRIC_PROBE_HIT_RATIO.set(METRIC_PROBE_CACHE.get(result="hit") / lookups if lookups else 0)
+
+    with SCRATCH.lock:
+        for root in SCRATCH.roots:
+            METRIC_SCRATCH_RESERVED.set(SCRATCH.get_reserved(root), root=root)
+            METRIC_SCRATCH_FREE.set(SCRATCH.get_free_space(root), root=root)
+
+
+# ==================================================================================================
+# Source Cache
+# ==================================================================================================
+
+
+def get_source_cache_key(videoPath: str) -> str:
+    stat = os.stat(videoPath)
+    return get_hash(f"{videoPath}|{stat.st_size}|{stat.st_mtime}")
+
+
+SOURCE_CACHE_FOLDER = f"{CACHE_FOLDER}sources{os.sep}"
+
+
+# kept in memory too, so --watch doesn't read them all again on every config change
+PROBE_OUTPUTS: Dict[str, str] = {}
+
+
+# the ffprobe output for a source, cached on its path, size and date modified
+@profiled()
+def get_probe_output(videoPath: str) -> str:
+    cacheKey = get_source_cache_key(videoPath)
+    probeFile = f"{SOURCE_CACHE_FOLDER}{cacheKey}.probe"
+
+    if cacheKey in PROBE_OUTPUTS:
+        METRIC_PROBE_CACHE.inc(result="hit")
+        return PROBE_OUTPUTS[cacheKey]
+
+    if os.path.isfile(probeFile):
+        METRIC_PROBE_CACHE.inc(result="hit")
+        with open(probeFile, mode="r", encoding="utf-8") as file:
+            PROBE_OUTPUTS[cacheKey] = file.read()
+        return PROBE_OUTPUTS[cacheKey]
+
+    METRIC_PROBE_CACHE.inc(result="miss")
+
+    # only reads headers, extra threads just get in the way of the encodes
+    ffprobe_command = "ffprobe -threads 1 -v error -show_streams -show_format " \
+                      "-of default=noprint_wrappers=1 \"" + videoPath + '"'
+
+    output = subprocess.check_output(ffprobe_command, shell=True, universal_newlines=True)
+    write_cache_file(probeFile, output)
+    PROBE_OUTPUTS[cacheKey] = output
+    return output
+
+
+# writes to a temp file first, so a cancelled run never leaves half a cache file behind
+def write_cache_file(path: str, text: str):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path + ".tmp", mode="w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(path + ".tmp", path)
+
+
+SCENE_COMPLEXITY_WEIGHT = 0.25
+SCENE_BUSY_CUTS_PER_MINUTE = 30
+
+
+# None if ffmpeg failed
+@profiled()
+def find_scene_cuts(videoPath: str, threshold: float) -> List[float]:
+    # low res is plenty for finding cuts and a lot cheaper to run the filter on
+    cmd = (
+        "ffmpeg -hide_banner -nostats -threads 2",
+        f"-i \"{videoPath}\"",
+        "-an -sn -dn",
+        f"-vf \"scale=160:-2,select='gt(scene,{threshold})',showinfo\"",
+        "-f null -",
+    )
+
+    ffmpeg = subprocess.run(" ".join(cmd), shell=True, universal_newlines=True, errors="replace",
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # a decode that stopped early only found the cuts before that point
+    if ffmpeg.returncode != 0:
+        return None
+
+    sceneCuts = []
+    for line in ffmpeg.stderr.splitlines():
+        if "Parsed_showinfo" not in line or "pts_time:" not in line:
+            continue
+        sceneCuts.append(float(line.split("pts_time:")[1].split()[0]))
+
+    return sceneCuts
+
+
+# finds scene changes in every input once in the background, and caches them next to the probe output
+class SceneIndexer:
+    def __init__(self):
+        self.enabled = ARGS.scene_index or ARGS.snap_to_scenes > 0
+        self.executor = None
+        self.futures: Dict[str, concurrent.futures.Future] = {}
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, ARGS.scene_workers))
+
+    @staticmethod
+    def get_cache_path(videoPath: str) -> str:
+        return f"{SOURCE_CACHE_FOLDER}{get_source_cache_key(videoPath)}_{ARGS.scene_threshold}.scenes"
+
+    def queue(self, videoPath: str):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            if videoPath not in self.futures:
+                self.futures[videoPath] = self.executor.submit(self.index_video, videoPath)
+
+    def queue_all(self, videoPaths: List[str]):
+        for videoPath in videoPaths:
+            self.queue(videoPath)
+
+    def index_video(self, videoPath: str) -> List[float]:
+        cachePath = self.get_cache_path(videoPath)
+
+        if os.path.isfile(cachePath):
+            with open(cachePath, mode="r", encoding="utf-8") as file:
+                return [float(line) for line in file.read().splitlines() if line]
+
+        print(f"Indexing Scene Changes: {videoPath}")
+        sceneCuts = find_scene_cuts(videoPath, ARGS.scene_threshold)
+        if sceneCuts is None:
+            # not cached, so the next run tries again
+            print(f"ffmpeg failed indexing scene changes in {videoPath}, not using them")
+            return None
+
+        write_cache_file(cachePath, "\n".join(str(cut) for cut in sceneCuts))
+        print(f"Found {len(sceneCuts)} Scene Changes: {videoPath}")
+        return sceneCuts
+
+    # None if indexing is off, or not done yet and we didn't want to wait
+    def get_scenes(self, videoPath: str, wait: bool = True) -> List[float]:
+        if not self.enabled:
+            return None
+
+        self.queue(videoPath)
+        future = self.futures[videoPath]
+
+        if not wait and not future.done():
+            return None
+
+        try:
+            return future.result()
+        except Exception as F:
+            print(f"Failed to index scene changes in {videoPath} - {F}")
+            return None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
 # ==================================================================================================
 # Timestamp File Parsing
 # ==================================================================================================
 
 ALL_INPUT_VIDEOS = []
 
+# lexed config files, only read again once they change
+CONFIG_FILES: Dict[str, Tuple[Tuple[float, int], lexer.DemezKeyValueRoot]] = {}
+
+
+def get_file_signature(path: str) -> Tuple[float, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0.0, -1
+    return stat.st_mtime, stat.st_size
+
+
+def read_config_file(path: str) -> lexer.DemezKeyValueRoot:
+    fullPath = os.path.abspath(path)
+    signature = get_file_signature(fullPath)
+
+    if fullPath in CONFIG_FILES and CONFIG_FILES[fullPath][0] == signature:
+        return CONFIG_FILES[fullPath][1]
+
+    with PROFILER.span("lexer.ReadFile"):
+        config = lexer.ReadFile(path)
+
+    CONFIG_FILES[fullPath] = (signature, config)
+    return config
+
 
 class VideoSettings:
     def __init__(self):
@@ -212,9 +496,14 @@ class OutputVideoSettings(VideoSettings):
         
         # self.useDateMod = True
         self.timeCfg = "v0"  # use input video 0's date modified by default
+
+        # list of (min, max) output sizes in bytes, more than one makes an output for each one
+        self.sizeTargets: List[Tuple[int, int]] = []
         
     def copy_settings(self, other):
         super().copy_settings(other)
+
+        self.sizeTargets = other.sizeTargets.copy()
         
         self.videoPrefix = other.videoPrefix
         self.videoPrefixRaw = other.videoPrefixRaw
@@ -249,6 +538,13 @@ class OutputVideoSettings(VideoSettings):
             # self.useDateMod = block_obj.value == "true" or block_obj.value == "1"
             self.timeCfg = block_obj.value
             return True
+
+        elif block_obj.key == "$sizeTargets":
+            try:
+                self.sizeTargets = parse_size_targets(block_obj.value)
+            except ValueError:
+                block_obj.Warning("Invalid size targets, expected sizes in MB like \"10 25 50\" or \"21-25 50\"")
+            return True
     
         return False
     
@@ -266,6 +562,9 @@ class VideoFile(VideoSettings):
 
         self.origInfo = {}
 
+        # scene changes in seconds, only set if the scene index was ready while parsing the config
+        self.sceneCuts: List[float] = None
+
         self.markers_tmp = []
 
         self.get_orig_info()
@@ -283,8 +582,47 @@ class VideoFile(VideoSettings):
     def add_marker_ex(self, name: str, start: str, end: str):
         self.markers_tmp.append([name, to_timedelta(start), self.get_video_length() if end == '' else to_timedelta(end)])
 
-    def add_time_range(self, start: str, end: str):
-        self.timeRanges.append([to_timedelta(start), self.get_video_length() if end == '' else to_timedelta(end)])
+    def add_time_range(self, start: str, end: str) -> bool:
+        timeRange = [to_timedelta(start), self.get_video_length() if end == '' else to_timedelta(end)]
+
+        # catch these here instead of when printing the timestamps
+        if timeRange[1] <= timeRange[0]:
+            return False
+
+        self.timeRanges.append(timeRange)
+        return True
+
+    # merges back to back time ranges into one, so we don't pay for an extra ffmpeg process, seek and temp file
+    # overlapping ranges are left alone, merging those would drop the repeated part from the output
+    def merge_time_ranges(self) -> int:
+        if len(self.timeRanges) < 2:
+            return 0
+
+        # anything within half a frame of each other is the same cut point
+        fps = self.origInfo["fps"]
+        tolerance = timedelta(seconds=0.5 / fps) if fps else timedelta(seconds=0)
+
+        mergedRanges = [list(self.timeRanges[0])]
+        for timeRange in self.timeRanges[1:]:
+            prevRange = mergedRanges[-1]
+
+            if abs(timeRange[0] - prevRange[1]) <= tolerance:
+                prevRange[1] = timeRange[1]
+                continue
+
+            if ARGS.verbose and timeRange[0] < prevRange[1] and prevRange[0] < timeRange[1]:
+                print(f"  Overlapping time ranges in \"{self.videoName}\": "
+                      f"({prevRange[0]} - {prevRange[1]}) and ({timeRange[0]} - {timeRange[1]})")
+
+            mergedRanges.append(list(timeRange))
+
+        mergeCount = len(self.timeRanges) - len(mergedRanges)
+        self.timeRanges = mergedRanges
+
+        if mergeCount and ARGS.verbose:
+            print(f"  Merged {mergeCount} time range(s) in \"{self.videoName}\"")
+
+        return mergeCount
 
     # duration in seconds
     def get_duration_range(self, index: int) -> float:
@@ -328,17 +666,52 @@ class VideoFile(VideoSettings):
             bitrate = (outputSize / durations[index]) * 8
             # subtract audio bitrate
             bitrate -= audioBitrate
+            # give a bit more to busier clips, this gets scaled back down to the target size after
+            bitrate *= self.get_complexity_weight(index)
             bitrates.append(bitrate)
         return bitrates
 
+    # more scene changes per minute usually means harder to encode
+    def get_complexity_weight(self, index: int) -> float:
+        if not self.sceneCuts:
+            return 1.0
+
+        start = self.timeRanges[index][0].total_seconds()
+        end = self.timeRanges[index][1].total_seconds()
+        cuts = sum(1 for cut in self.sceneCuts if start < cut < end)
+        cutsPerMinute = cuts / max((end - start) / 60, 1 / 60)
+
+        return 1.0 + SCENE_COMPLEXITY_WEIGHT * min(cutsPerMinute / SCENE_BUSY_CUTS_PER_MINUTE, 1.0)
+
+    # moves the start and end of each time range to the closest scene change, for sloppy hand typed timestamps
+    def snap_time_ranges(self, tolerance: float) -> int:
+        if not self.sceneCuts:
+            return 0
+
+        snapCount = 0
+        for timeRange in self.timeRanges:
+            for side in range(2):
+                seconds = timeRange[side].total_seconds()
+                cut = min(self.sceneCuts, key=lambda sceneCut: abs(sceneCut - seconds))
+
+                if 0 < abs(cut - seconds) <= tolerance:
+                    timeRange[side] = timedelta(seconds=cut)
+                    snapCount += 1
+
+        # don't let snapping make a range empty
+        self.timeRanges = [timeRange for timeRange in self.timeRanges if timeRange[1] > timeRange[0]]
+
+        if snapCount and ARGS.verbose:
+            print(f"  Snapped {snapCount} timestamp(s) to scene changes in \"{self.videoName}\"")
+
+        return snapCount
+
     def get_video_length(self):
         return self.origInfo["duration"]
 
+    @profiled()
     def get_orig_info(self):
-        ffprobe_command = "ffprobe -threads 6 -v error -show_streams -show_format " \
-                          "-of default=noprint_wrappers=1 \"" + self.videoPath + '"'
-
-        output = subprocess.check_output(ffprobe_command, shell=True)
+        output = get_probe_output(self.videoPath)
 
         self.origInfo["bitrate"] = 0
         self.origInfo["duration"] = 0
@@ -346,14 +719,13 @@ class VideoFile(VideoSettings):
         self.origInfo["height"] = 0
         self.origInfo["fps"] = 0
         self.origInfo["fps2"] = "0/0"
+        self.origInfo["audio"] = False
 
         # clean up the output
-        for line in str(output).split("\\n"):
-            if line.startswith("b\'"):
-                line = line.split("b\'")[1]
-            line = line.split("\\r")[0]
+        for line in output.splitlines():
+            line = line.strip()
             
-            if line.endswith("N/A") or line == '\'' or line == '"':
+            if line.endswith("N/A") or "=" not in line:
                 continue
                 
             key, value = line.rsplit("=", 1)
@@ -370,6 +742,9 @@ class VideoFile(VideoSettings):
             elif key == "height":
                 self.origInfo["height"] = int(value)
 
+            elif key == "codec_type" and value == "audio":
+                self.origInfo["audio"] = True
+
             elif key == "r_frame_rate":
                 if value == "0/0":
                     continue
@@ -383,9 +758,10 @@ class VideoFile(VideoSettings):
 
 
 class OutputVideo(OutputVideoSettings):
-    def __init__(self, videoPath: str):
+    def __init__(self, videoPath: str, raw: bool):
         super().__init__()
 
+        self.raw = raw
         self.videoPath = os.path.abspath(videoPath)
         self.videoName = os.path.split(self.videoPath)[1]
         self.videoDir = os.path.split(self.videoPath)[0]
@@ -402,9 +778,13 @@ class OutputVideo(OutputVideoSettings):
         self.dateFile = ""
 
         self.markers = []
+
+        self.minFileSize = MIN_FILE_SIZE
+        self.maxFileSize = MAX_FILE_SIZE
+        self.ladder: SizeLadder = None
         
     def get_video_name(self) -> str:
-        if ARGS.encode_raw:
+        if self.raw:
             return self.videoPrefixRaw + os.path.splitext(self.videoName)[0] + self.videoExtRaw
         else:
             return self.videoPrefix + os.path.splitext(self.videoName)[0] + self.videoExt
@@ -415,6 +795,61 @@ class OutputVideo(OutputVideoSettings):
     def get_video_path(self) -> str:
         return os.path.normpath(self.videoDir + os.sep + self.get_video_name())
         
+    # everything parsed from the output's block, the hash list leaves out settings that don't change the file name
+    # or clips, like the target size, so it isn't enough to tell if the block changed
+    def get_definition(self) -> Tuple[str, ...]:
+        definition = [*self.hashList, self.videoPrefix, self.videoPrefixRaw, self.videoExt, self.videoExtRaw,
+                      self.timeCfg, str(self.sizeTargets), str(self.minFileSize), str(self.maxFileSize),
+                      str(self.targetSize), str(self.audioBitrate), str(self.markers),
+                      " ".join(self.cmd), " ".join(self.cmdRaw), " ".join(self.cmdPass1), " ".join(self.cmdPass2)]
+
+        for inputVideo in self.inputVideos:
+            definition.extend([inputVideo.videoPath, str(inputVideo.timeRanges), str(inputVideo.targetSize),
+                               str(inputVideo.audioBitrate), " ".join(inputVideo.cmd), " ".join(inputVideo.cmdRaw),
+                               " ".join(inputVideo.cmdPass1), " ".join(inputVideo.cmdPass2)])
+
+        return tuple(definition)
+
+    # one output video for each size target, sharing the same inputs
+    def create_renditions(self) -> List["OutputVideo"]:
+        if self.raw or not self.sizeTargets:
+            return [self]
+
+        # the size has to be in the hash, or changing it would just skip the output
+        if len(self.sizeTargets) == 1:
+            minSize, maxSize = self.sizeTargets[0]
+            self.hashList.append(get_hash(f"{minSize}-{maxSize}"))
+            self.set_size_target(minSize, maxSize)
+            return [self]
+
+        self.ladder = SizeLadder()
+        for minSize, maxSize in self.sizeTargets:
+            rendition = copy.copy(self)
+            base, ext = os.path.splitext(self.videoPath)
+            rendition.videoPath = f"{base}_{maxSize / BYTES_PER_MB:g}mb{ext}"
+            rendition.videoName = os.path.split(rendition.videoPath)[1]
+            rendition.hashList = self.hashList + [get_hash(f"{minSize}-{maxSize}")]
+            rendition.set_size_target(minSize, maxSize)
+            self.ladder.renditions.append(rendition)
+
+        # each rendition moves its inputs when done, so they all need to be in the queue
+        for _ in self.ladder.renditions[1:]:
+            ALL_INPUT_VIDEOS.extend([inputVideo.videoPath for inputVideo in self.inputVideos])
+
+        return self.ladder.renditions
+
+    # audio is encoded once per time range and muxed in after the size loop, so retries only redo video
+    # needs audio in every input, otherwise the clips won't line up
+    def use_split_audio(self) -> bool:
+        if self.raw or ARGS.no_split_audio:
+            return False
+        return all(inputVideo.origInfo["audio"] for inputVideo in self.inputVideos)
+
+    def set_size_target(self, minSize: int, maxSize: int):
+        self.minFileSize = minSize
+        self.maxFileSize = maxSize
+        self.targetSize = (minSize + maxSize) / 2 / 1024
+
     def create_input_video(self, videoPath: str) -> VideoFile:
         # if check:
         #    for input_video_obj in self.inputVideos:
@@ -482,69 +917,38 @@ class OutputVideo(OutputVideoSettings):
 
         return metadata
 
-    @staticmethod
-    # def get_metadata_chapter_str(name, pos: timedelta) -> list:
-    def get_metadata_chapter_str2(name, start: timedelta) -> list:
-        name = name.replace('#', '\\#')
-        start_new = start.total_seconds() * 1000
-        metadata = [
-            "[CHAPTER]",
-            "TIMEBASE=1/1000",
-            f"START={start_new}",
-            f"END={start_new}",
-            f"title={name}",
-            ""  # empty line for spacing
-        ]
+    # chapters as (title, position in seconds), they go in the concat script and the titles in the metadata cmd
+    def get_chapters(self) -> List[Tuple[str, float]]:
+        if not self.get_date_file():
+            return []
 
-        print(f"Adding Chapter Metadata: {name} - {start}")
+        chapters = []
+        for marker in self.markers:
+            # chapters.append((marker[0], marker[1], marker[2]))
+            chapters.append((marker[0], marker[1].total_seconds()))
+            chapters.append((marker[0], marker[2].total_seconds()))
 
-        return metadata
+        return chapters
 
     def get_metadata_cmd(self) -> List[str]:
         videoFile: str = self.get_date_file()
         if not videoFile:
             return []
 
-        # write a metadata file
-        metadataFolder = f"{ROOT_FOLDER}metadata"
-
-        if not os.path.exists(metadataFolder):
-            os.makedirs(metadataFolder)
-
-        # videoName = f"{metadataFolder}/{os.path.splitext(os.path.basename(self.get_date_file()))[0]}.txt"
-        videoName = f"{metadataFolder}/{self.videoName}.txt"
-
         date_mod = datetime.fromtimestamp(os.path.getmtime(videoFile))
         date_access = datetime.fromtimestamp(os.path.getatime(videoFile))
 
-        metadata = [
-            ";FFMETADATA1",
-            "",
-            # 'demez_date_encoded="' + str(datetime.now()).replace(':', '-') + '"',
-            # 'demez_date_modified="' + str(date_mod).replace(':', '-') + '"',
-        ]
-
-        # if os.name == "nt":
-        #     date_created = datetime.fromtimestamp(get_date_created(videoFile))
-        #     metadata.append('demez_date_created="' + str(date_created).replace(':', '-') + '"')
-
-        for marker in self.markers:
-            # metadata.extend(self.get_metadata_chapter_str(marker[0], marker[1], marker[2]))
-            metadata.extend(self.get_metadata_chapter_str2(marker[0], marker[1]))
-            metadata.extend(self.get_metadata_chapter_str2(marker[0], marker[2]))
-
-        with open(videoName, "w") as metadata_file:
-            metadata_file.write("\n".join(metadata))
-
         metadata_cmd = [
-            # f"-f ffmetadata -i \"metadata{os.sep}{videoName}.txt\"",
-            f"-i \"{videoName}\"",
             f"-map_metadata 0",
-            f"-map_metadata 1",
             '-metadata demez_date_encoded="' + str(datetime.now()).replace(':', '-') + '"',
             '-metadata demez_date_modified="' + str(date_mod).replace(':', '-') + '"',
         ]
 
+        for index, (name, pos) in enumerate(self.get_chapters()):
+            print(f"Adding Chapter Metadata: {name} - {timedelta(seconds=pos)}")
+            name = name.replace('"', "'")
+            metadata_cmd.append(f'-metadata:c:{index} title="{name}"')
+
         if os.name == "nt":
             date_created = datetime.fromtimestamp(get_date_created(videoFile))
             metadata_cmd.append('-metadata demez_date_created="' + str(date_created).replace(':', '-') + '"')
@@ -645,11 +1049,13 @@ def print_timestamps(video_list: List[OutputVideo]):
 
 
 class VideoConfig(OutputVideoSettings):
-    def __init__(self):
+    def __init__(self, raw: bool):
         super().__init__()
+        self.raw = raw
         self.configPath = ""
         self.configFolder = ""
         self.configKV = None
+        self.configFiles: List[str] = []  # the config and everything it includes
         
         self.searchPaths: List[str] = []
         self.videoList: List[OutputVideo] = []
@@ -664,11 +1070,13 @@ class VideoConfig(OutputVideoSettings):
         self.configFolder = os.path.split(self.configPath)[0]
         return True
         
+    @profiled()
     def load(self, path: str):
         if not self.set_config_path(path):
             return
 
-        self.configKV: lexer.DemezKeyValueRoot = lexer.ReadFile(self.configPath)
+        self.configKV: lexer.DemezKeyValueRoot = read_config_file(self.configPath)
+        self.configFiles.append(self.configPath)
         self.searchPaths.append(self.configFolder)
 
         if self.configFolder not in ALL_SEARCH_PATHS:
@@ -686,7 +1094,8 @@ class VideoConfig(OutputVideoSettings):
                 # prevInputDirStack: List[str] = self.inputDirStack.copy()
                 prevConfigPath: str = self.configPath
 
-                include_config: lexer.DemezKeyValueRoot = lexer.ReadFile(kvBlock.value)
+                include_config: lexer.DemezKeyValueRoot = read_config_file(kvBlock.value)
+                self.configFiles.append(os.path.abspath(kvBlock.value))
                 self.set_config_path(os.path.join(self.configFolder, os.path.split(kvBlock.value)[0]))
                 # self.inputDirStack.append(self.configFolder)
                 self.parse_config(include_config)
@@ -715,9 +1124,9 @@ class VideoConfig(OutputVideoSettings):
 
                     if not addVideo:
                         # skip the video if we don't want it on this pass
-                        if kvBlock.condition == "$RAW$" and ARGS.encode_raw:
+                        if kvBlock.condition == "$RAW$" and self.raw:
                             addVideo = True
-                        elif kvBlock.condition == "!$RAW$" and not ARGS.encode_raw:
+                        elif kvBlock.condition == "!$RAW$" and not self.raw:
                             addVideo = True
                 
                 # TODO: refactor this to store the output videos in two lists, raw and normal
@@ -725,17 +1134,32 @@ class VideoConfig(OutputVideoSettings):
                 #  this way, you can do both in one pass
                 
                 if addVideo:
-                    outputVideo = OutputVideo(kvBlock.key)
+                    outputVideo = OutputVideo(kvBlock.key, self.raw)
                     outputVideo.copy_settings(self)
 
                     # outputVideo.hashList.append(get_hash(self.inputDirStack[-1]))
-                    outputVideo.hashList.append(get_hash(str(ARGS.encode_raw)))
+                    outputVideo.hashList.append(get_hash(str(self.raw)))
                     
                     if kvBlock.value:
                         self.parse_output_video(outputVideo, kvBlock)
+
+                    if SCENE_INDEXER.enabled:
+                        # start them all first so they index in parallel
+                        for inputVideo in outputVideo.inputVideos:
+                            SCENE_INDEXER.queue(inputVideo.videoPath)
+
+                        for inputVideo in outputVideo.inputVideos:
+                            inputVideo.sceneCuts = SCENE_INDEXER.get_scenes(inputVideo.videoPath,
+                                                                            wait=ARGS.snap_to_scenes > 0)
+                            if ARGS.snap_to_scenes > 0:
+                                inputVideo.snap_time_ranges(ARGS.snap_to_scenes)
+
+                    if not ARGS.no_merge_ranges:
+                        for inputVideo in outputVideo.inputVideos:
+                            inputVideo.merge_time_ranges()
                         
                     # add a bunch of hashes
-                    if ARGS.encode_raw:
+                    if self.raw:
                         # outputVideo.hashList.append(get_hash(" ".join(outputVideo.cmdRaw)))
                         outputVideo.hashList.append(get_hash(outputVideo.videoPrefixRaw))
                     else:
@@ -745,7 +1169,7 @@ class VideoConfig(OutputVideoSettings):
                     for inputVideo in outputVideo.inputVideos:
                         outputVideo.hashList.append(get_hash(inputVideo.videoPath))
                         
-                        if ARGS.encode_raw:
+                        if self.raw:
                             outputVideo.hashList.append(get_hash(" ".join(inputVideo.cmdRaw)))
                         else:
                             outputVideo.hashList.append(get_hash(" ".join(inputVideo.cmd)))
@@ -781,25 +1205,26 @@ class VideoConfig(OutputVideoSettings):
                         last_video_time += timedelta(seconds=video.get_duration())
 
                     # Finally, Add the Output Video the list of videos to process
-                    self.videoList.append(outputVideo)
-
-                    if ARGS.move_files:
-                        # print(f"  Output Video: {outputVideo.get_video_name()}")
-                        continue
-
-                    elif not check_hash_file(outputVideo, outputVideo.hashList):
-                        set_con_color(Color.GREEN)
-                        print(f"  Skipping Output: {outputVideo.get_video_name()}")
-                        # print(f"  Skipping Output Video:")
-                        # dump_output_video_info(outputVideo)
-                        set_con_color(Color.DEFAULT)
-                        outputVideo.skip = True
-
-                    # elif not os.path.isfile(outputVideo.get_video_path()):
-                    else:
-                        print(f"  Adding Output:   {outputVideo.get_video_name()}")
-                        # dump_output_video_info(outputVideo)
-                        continue
+                    for outputVideo in outputVideo.create_renditions():
+                        self.videoList.append(outputVideo)
+
+                        if ARGS.move_files:
+                            # print(f"  Output Video: {outputVideo.get_video_name()}")
+                            continue
+
+                        elif not check_hash_file(outputVideo, outputVideo.hashList):
+                            set_con_color(Color.GREEN)
+                            print(f"  Skipping Output: {outputVideo.get_video_name()}")
+                            # print(f"  Skipping Output Video:")
+                            # dump_output_video_info(outputVideo)
+                            set_con_color(Color.DEFAULT)
+                            outputVideo.skip = True
+
+                        # elif not os.path.isfile(outputVideo.get_video_path()):
+                        else:
+                            print(f"  Adding Output:   {outputVideo.get_video_name()}")
+                            # dump_output_video_info(outputVideo)
+                            continue
 
                     # elif ARGS.move_files:
                     #     print(f"  Adding Output:   {outputVideo.get_video_name()}")
@@ -809,6 +1234,7 @@ class VideoConfig(OutputVideoSettings):
         for search_path in ALL_SEARCH_PATHS:
             print_color(Color.CYAN, f"    \"{search_path}\"")
 
+    @profiled()
     def get_video_path(self, video_path) -> str:
         if os.path.isabs(video_path):
             if os.path.isfile(video_path):
@@ -888,10 +1314,10 @@ class VideoConfig(OutputVideoSettings):
             video_file.cmdRaw.append(in_video_item.value)
 
         elif in_video_item.key == "$markers":
-            if in_video_item.condition == "$RAW$" and not ARGS.encode_raw:
+            if in_video_item.condition == "$RAW$" and not self.raw:
                 return
 
-            elif in_video_item.condition == "!$RAW$" and ARGS.encode_raw:
+            elif in_video_item.condition == "!$RAW$" and self.raw:
                 return
 
             elif in_video_item._value_type != list:
@@ -905,19 +1331,24 @@ class VideoConfig(OutputVideoSettings):
         else:
             if in_video_item.condition:
                 # BLECH
-                if in_video_item.condition == "$RAW$" and ARGS.encode_raw:
-                    video_file.add_time_range(in_video_item.key, in_video_item.value)
+                if in_video_item.condition == "$RAW$" and self.raw:
+                    self.add_time_range(video_file, in_video_item)
 
-                elif in_video_item.condition == "!$RAW$" and not ARGS.encode_raw:
-                    video_file.add_time_range(in_video_item.key, in_video_item.value)
+                elif in_video_item.condition == "!$RAW$" and not self.raw:
+                    self.add_time_range(video_file, in_video_item)
                 #else:
                 #    in_video_item.Warning("Unknown Condition")
 
                 # Automatically add markers for this
-                if in_video_item.condition != "$RAW$" and ARGS.encode_raw:
+                if in_video_item.condition != "$RAW$" and self.raw:
                     video_file.add_auto_marker(in_video_item.key, in_video_item.value)
             else:
-                video_file.add_time_range(in_video_item.key, in_video_item.value)
+                self.add_time_range(video_file, in_video_item)
+
+    @staticmethod
+    def add_time_range(video_file: VideoFile, in_video_item: lexer.DemezKeyValue):
+        if not video_file.add_time_range(in_video_item.key, in_video_item.value):
+            in_video_item.Warning("Time range is zero-length or reversed, skipping it")
 
 
 def get_time_diff(dt_start, dt_end):
@@ -942,6 +1373,26 @@ def to_timedelta(timestamp_str: str) -> timedelta:
     return timedelta(seconds=total_seconds)
 
 
+# "10 25 50" or "21-25 50", sizes in MB
+def parse_size_targets(value: str) -> List[Tuple[int, int]]:
+    sizeTargets = []
+    for target in value.split():
+        if "-" in target:
+            minSize, maxSize = target.split("-", 1)
+            minSize = int(float(minSize) * BYTES_PER_MB)
+            maxSize = int(float(maxSize) * BYTES_PER_MB)
+        else:
+            # same ratio as the default min and max file size
+            maxSize = int(float(target) * BYTES_PER_MB)
+            minSize = int(maxSize * MIN_FILE_SIZE / MAX_FILE_SIZE)
+
+        if minSize <= 0 or maxSize <= minSize:
+            raise ValueError(f"invalid size target: {target}")
+
+        sizeTargets.append((minSize, maxSize))
+    return sizeTargets
+
+
 def to_datetime(datetime_str: str) -> datetime:
     date, time = datetime_str.split(" ", 1)
     year, month, day = date.split('-')
@@ -955,18 +1406,33 @@ def to_datetime(datetime_str: str) -> datetime:
 # ==================================================================================================
 
 
+# hash files we've read or written, so --watch only reads each of them once
+HASH_FILES: Dict[str, List[str]] = {}
+HASH_LOCK = threading.Lock()
+
+
+def read_hash_file(video_name) -> List[str]:
+    with HASH_LOCK:
+        if video_name not in HASH_FILES:
+            hashPath = os.path.join(ROOT_FOLDER, "hashes", video_name + ".hash")
+            if not os.path.isfile(hashPath):
+                return None
+
+            with open(hashPath, mode="r", encoding="utf-8") as file:
+                HASH_FILES[video_name] = file.read().splitlines()
+
+        return HASH_FILES[video_name]
+
+
 def check_hash_file(videoFile: OutputVideo, hashList):
     # filename = os.path.basename(videoFile.get_video_name())
     filename = get_hash(videoFile.get_video_path())
     if ARGS.verbose:
         print("Checking Hash: " + filename + ".hash")
     
-    video_crc_path = os.path.join(ROOT_FOLDER, "hashes", filename + ".hash")
+    crc_file = read_hash_file(filename)
     
-    if os.path.isfile(video_crc_path):
-        with open(video_crc_path, mode="r", encoding="utf-8") as file:
-            crc_file = file.read().splitlines()
-        
+    if crc_file is not None:
         valid_crcs = []
         for video_crc in crc_file:
             if video_crc not in hashList:
@@ -986,146 +1452,438 @@ def check_hash_file(videoFile: OutputVideo, hashList):
         return True
 
 
-def ffmpeg_line_reader(ffmpeg, outFile: str, max_size: int):
-    ffmpeg_output = b""
-    while True:
-        time.sleep(0.1)
-        poll = ffmpeg.poll()
-        if poll is not None:
-            break
+# need this much of a clip encoded before the bitrate is worth trusting, the start of a clip is usually way off
+EARLY_ABORT_MIN_PROGRESS = 0.25
+EARLY_ABORT_MIN_SECONDS = 5.0
 
-        # lines: List[bytes] = ffmpeg.stdout.readlines()
+# how far past the expected clip size the projection has to be before we give up on it
+EARLY_ABORT_MARGIN = 0.2
 
-        for line in ffmpeg.stdout:
-            # time.sleep(0.1)
-            sys.stdout.write(line.decode())
-            ffmpeg_output += line
 
-            if max_size is not None:
-                continue
+# live stats from ffmpeg's -progress output
+class FFmpegProgress:
+    def __init__(self, duration: float = 0.0, sizeWindow: Tuple[float, float] = None):
+        self.duration = duration  # in seconds
+        self.sizeWindow = sizeWindow  # (min, max) in bytes, the encode gets killed if it's clearly landing outside this
 
-            if b"size=" in line:
-                # use the total time range and divide it by ffmpeg's current time in the encode to get a percentage
-                current_size = line.split(b"size= ")[1].split(b"kB time=")[0].strip()
-                current_bitrate = line.split(b"bitrate=")[1].split(b" speed=")[0].strip()
+        self.outTime = 0.0  # in seconds
+        self.totalSize = 0
+        self.bitrate = 0.0  # in kbps
+        self.fps = 0.0
+        self.speed = 0.0
+        self.finished = False
+        self.aborted = False
 
-                current_size = int(current_size.decode())
+    def update(self, key: str, value: str):
+        try:
+            if key == "out_time_us" or (key == "out_time_ms" and not self.outTime):
+                # out_time_ms is actually in microseconds too
+                self.outTime = max(int(value) / 1000000, 0.0)
 
-                if current_bitrate != b"N/A":
-                    current_bitrate = int(current_bitrate.decode())
-                else:
-                    current_bitrate = 0.0
+            elif key == "total_size":
+                self.totalSize = int(value)
 
-                # print("cur size: " + str(current_size))
+            elif key == "bitrate" and value.endswith("kbits/s"):
+                self.bitrate = float(value[:-len("kbits/s")])
 
-        if max_size is not None and os.path.isfile(outFile):
-            size = os.path.getsize(outFile)
+            elif key == "fps":
+                self.fps = float(value)
 
-            if size > max_size:
-                ffmpeg.kill()
-                print("ASDIHJAIU(WDHJUIO(WDHIUADW")
+            elif key == "speed" and value.endswith("x"):
+                self.speed = float(value[:-1])
+
+            elif key == "progress":
+                self.finished = value == "end"
+
+        except ValueError:
+            # N/A and friends
+            pass
+
+    def get_projected_size(self) -> float:
+        if self.outTime <= 0 or self.duration <= 0:
+            return float(self.totalSize)
+        return self.totalSize * (self.duration / self.outTime)
+
+    def should_abort(self) -> bool:
+        if not self.sizeWindow or self.duration <= 0 or self.finished:
+            return False
+
+        if self.outTime < max(EARLY_ABORT_MIN_SECONDS, self.duration * EARLY_ABORT_MIN_PROGRESS):
+            return False
+
+        projectedSize = self.get_projected_size()
+        return projectedSize < self.sizeWindow[0] or projectedSize > self.sizeWindow[1]
+
+
+def ffmpeg_stderr_reader(ffmpeg, jobName: str, lastLines: collections.deque):
+    set_log_job(jobName)
+    for line in ffmpeg.stderr:
+        line = line.rstrip()
+        if line:
+            lastLines.append(line)
+            log(Level.DEBUG, line)
+
+
+def ffmpeg_line_reader(ffmpeg, progress: FFmpegProgress):
+    for line in ffmpeg.stdout:
+        key, _, value = line.strip().partition("=")
+        progress.update(key, value.strip())
+
+        if not progress.aborted and progress.should_abort():
+            progress.aborted = True
+            print(f"\nEarly Abort: projected size {progress.get_projected_size() / BYTES_PER_MB:.2f} MB is outside "
+                  f"{progress.sizeWindow[0] / BYTES_PER_MB:.2f} - {progress.sizeWindow[1] / BYTES_PER_MB:.2f} MB "
+                  f"at {progress.outTime:.1f}/{progress.duration:.1f} sec")
+            ffmpeg.kill()
+
+
+# one line per running ffmpeg with the stats from -progress, and totals with an eta, kept under the log.
+# prints the same thing every so often instead when the console can't redraw lines
+class Dashboard:
+    REFRESH_RATE = 4  # per second, it only has to look alive
+    PLAIN_INTERVAL = 15.0  # seconds
+
+    def __init__(self):
+        self.enabled = not ARGS.no_dashboard and (ARGS.jobs > 1 or ARGS.dashboard)
+        self.live = self.enabled and can_show_status()
+        self.entries: Dict[int, Tuple[str, FFmpegProgress]] = {}
+        self.nextId = 0
+        self.totalJobs = 0
+        self.doneJobs = 0
+        self.totalSeconds = 0.0
+        self.doneSeconds = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, jobs):
+        if not self.enabled:
+            return
+
+        self.totalJobs = len(jobs)
+        self.totalSeconds = sum(output.get_duration() for job in jobs for output in job.outputs)
+        self.doneJobs = 0
+        self.doneSeconds = 0.0
+        self.stopped.clear()
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        if self.live:
+            set_status([])
+
+    def add(self, name: str, progress: FFmpegProgress) -> int:
+        with self.lock:
+            self.nextId += 1
+            self.entries[self.nextId] = (name, progress)
+            return self.nextId
+
+    def remove(self, entryId: int):
+        with self.lock:
+            self.entries.pop(entryId, None)
+
+    def job_done(self, job):
+        with self.lock:
+            self.doneJobs += 1
+            self.doneSeconds += sum(output.get_duration() for output in job.outputs)
+
+    def get_lines(self) -> List[str]:
+        with self.lock:
+            entries = list(self.entries.values())
+
+        lines = []
+        totalSpeed = 0.0
+        activeSeconds = 0.0
+
+        for name, progress in entries:
+            totalSpeed += progress.speed
+            activeSeconds += progress.outTime
+
+            duration = f"/{progress.duration:.1f}" if progress.duration else ""
+            line = f"{name[-48:]:<48} {(f'{progress.outTime:.1f}' + duration + 's'):>14}"
+            line += f" {progress.fps:6.1f} fps {progress.speed:6.2f}x"
 
+            if progress.sizeWindow:
+                line += f"  {progress.get_projected_size() / BYTES_PER_MB:6.2f} MB " \
+                        f"({progress.sizeWindow[0] / BYTES_PER_MB:.2f} - {progress.sizeWindow[1] / BYTES_PER_MB:.2f})"
+
+            lines.append(line)
+
+        # rough, retries and first passes go over the same seconds again
+        remaining = max(self.totalSeconds - self.doneSeconds - activeSeconds, 0.0)
+        eta = str(timedelta(seconds=int(remaining / totalSpeed))) if totalSpeed > 0 else "?"
+
+        lines.append(f"{len(entries)} running, {self.doneJobs}/{self.totalJobs} jobs done, "
+                     f"{totalSpeed:.2f}x total, ETA {eta}")
+        return lines
+
+    def run(self):
+        lastPlain = time.perf_counter()
+
+        while not self.stopped.wait(1 / self.REFRESH_RATE):
+            if self.live:
+                set_status(self.get_lines())
+            elif time.perf_counter() - lastPlain >= self.PLAIN_INTERVAL:
+                lastPlain = time.perf_counter()
+                print("\n".join(self.get_lines()))
+
+
+# the job the current thread is working on, threads started by a job have to be wrapped with job_thread
+JOB_STATE = threading.local()
+
+
+def get_job():
+    return getattr(JOB_STATE, "job", None)
+
+
+def get_job_cpus() -> List[int]:
+    job = get_job()
+    return job.cpus if job is not None and job.cpus else CPUS
+
+
+def job_thread(func):
+    job = get_job()
+    logJob = get_log_job()
+
+    def run(*args):
+        JOB_STATE.job = job
+        set_log_job(logJob)
+        return func(*args)
+
+    return run
+
+
+# encoder threading to match the cpus the job has, unless the command already sets it.
+# processes is how many ffmpegs this caller runs at once, they all share the job's cpus.
+# kept out of gen_encode_cmd, since the shared clip keys can't depend on which job ends up encoding them
+def get_thread_args(outputVideo: OutputVideo, inputVideo: VideoFile, processes: int = 1) -> str:
+    settings = inputVideo.cmd[-1] if inputVideo.cmd else ""
+    if "-threads" in settings:
+        return ""
+
+    job = get_job()
+    if job is not None:
+        processes *= job.parallel
+
+    threads = max(1, CPU_PLANNER.get_threads(get_job_cpus()) // max(1, processes))
+    args = f"-threads {threads}"
+
+    # webm defaults to vp9, which barely uses more than one thread without these
+    if "vp9" in settings or ("-c:v" not in settings and outputVideo.videoExt == ".webm"):
+        if "-row-mt" not in settings:
+            args += " -row-mt 1"
+
+        if "-tile-columns" not in settings:
+            # tile columns have to be at least 256 pixels wide, and it's set as log2 of the column count
+            columns = max(1, min(threads, inputVideo.origInfo["width"] // 256))
+            args += f" -tile-columns {columns.bit_length() - 1}"
+
+    return args
+
+
+def is_pipe(path: str) -> bool:
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def get_process_limits() -> ProcessLimits:
+    limits = ProcessLimits()
+    limits.cpus = CPUS
+    limits.nice = ARGS.nice
+    limits.ioClass = ARGS.io_class or ""
+    limits.cpuLimit = ARGS.cpu_limit
+    limits.memoryLimit = ARGS.memory_limit * BYTES_PER_MB
+
+    if ARGS.high:
+        limits.priority = PRIORITY_HIGH
+    elif ARGS.below_normal:
+        limits.priority = PRIORITY_BELOW_NORMAL
+    elif ARGS.idle:
+        limits.priority = PRIORITY_IDLE
+
+    return limits
+
+
+# reads the concat script from stdin, file has to be allowed since that's where the clips are.
+# newer ffmpeg opens - as fd: instead of pipe:, so both have to be allowed
+CONCAT_INPUT = "-protocol_whitelist file,pipe,fd -safe 0 -f concat -i -"
+
+
+def gen_concat_script(files: List[str], durations: List[float] = None, chapters: List[float] = None) -> str:
+    lines = ["ffconcat version 1.0"]
+
+    for index, file in enumerate(files):
+        # plain paths get resolved against the script's own url, which is the pipe it came in on
+        file = "file:" + os.path.abspath(file).replace("'", "'\\''")
+        lines.append(f"file '{file}'")
+        if durations:
+            lines.append(f"duration {durations[index]}")
+
+    for index, pos in enumerate(chapters or []):
+        lines.append(f"chapter {index} {pos} {pos}")
+
+    return "\n".join(lines) + "\n"
+
+
+def write_stdin(ffmpeg, text: str):
+    try:
+        ffmpeg.stdin.write(text)
+        ffmpeg.stdin.close()
+    except OSError:
+        # died before reading it all, run_ffmpeg will notice
+        pass
+
+
+# stdinText gets written to ffmpeg's stdin, for inputs like concat scripts that don't need to be a file
+@profiled()
+def run_ffmpeg(outFile: str, cmd: List[str], progress: FFmpegProgress = None, stdinText: str = None):
+    job = get_job()
+    if job is not None and job.cancelled.is_set():
+        return False
+
+    # the dashboard needs stats from everything, not just the encodes that track their size
+    if progress is None and DASHBOARD.enabled:
+        progress = FFmpegProgress()
+
+    if progress is not None:
+        cmd = [cmd[0], "-progress pipe:1", *cmd[1:]]
 
-def run_ffmpeg(outFile: str, cmd: List[str], max_size: int = None):
     # if ARGS.raw_ffmpeg:
     print("\nCommand Line: " + " ".join(cmd) + "\n")
 
+    if stdinText is not None and ARGS.verbose:
+        print(stdinText)
+
+    # ffmpeg's output from parallel jobs is unreadable on one console, so it goes to the log instead
+    captureStderr = ARGS.jobs > 1 or bool(ARGS.log_dir) or DASHBOARD.live
+    stderrLines = collections.deque(maxlen=20)
+
     # if not max_size:
     # subprocess.run(" ".join(cmd))
 
     # elif max_size:
     # NOTE: bring back when i feel like using the priority and cpu affinity
     if True:
-        priority = subprocess.NORMAL_PRIORITY_CLASS
-
-        if ARGS.high:
-            priority = subprocess.HIGH_PRIORITY_CLASS
-        elif ARGS.below_normal:
-            priority = subprocess.BELOW_NORMAL_PRIORITY_CLASS
-
         ffmpeg = subprocess.Popen(
-            " ".join(cmd),
-            universal_newlines=True,
-            # stdout=subprocess.PIPE,
+            split_cmd(" ".join(cmd)),
+            encoding="utf-8",
+            stdin=subprocess.PIPE if stdinText is not None else None,
+            stdout=subprocess.PIPE if progress is not None else None,
+            stderr=subprocess.PIPE if captureStderr else None,
             # stderr=subprocess.STDOUT,
-            # stderr=subprocess.PIPE,
             # stdout=sys.stdout,
             # stderr=sys.stdout,
             # shell=True,  # breaks setting cpu affinity
-            creationflags=priority,
+            creationflags=get_creation_flags(PROCESS_LIMITS),
         )
 
-        time.sleep(2)
+        limits = PROCESS_LIMITS.copy()
+        limits.cpus = get_job_cpus()
 
+        cgroupPath = ""
         try:
-            # LAZY HACK AHCAIODSW
-            if "concat" not in cmd:
-                p: psutil.Process = psutil.Process(ffmpeg.pid)
-                p.cpu_affinity(CPUS)
-
-                if ARGS.high:
-                    p.nice(psutil.HIGH_PRIORITY_CLASS)
-                elif ARGS.below_normal:
-                    p.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
-
-        except Exception as F:
+            cgroupPath = apply_process_limits(ffmpeg.pid, limits)
+        except (psutil.Error, OSError) as F:
             # could of closed already so oh well
-            print("error getting process with psutil: " + str(F))
-
-        index = 0
-        ffmpeg_output = ""
-
-        # p1 = threading.Thread(target=ffmpeg_line_reader, args=(ffmpeg, outFile, max_size))
-        # p1.daemon = True
-        # p1.start()
+            print("error setting process limits: " + str(F))
+
+        if stdinText is not None:
+            # in a thread, a big enough script can fill up the pipe before ffmpeg starts reading it
+            writer = threading.Thread(target=write_stdin, args=(ffmpeg, stdinText))
+            writer.daemon = True
+            writer.start()
+
+        reader = None
+        if progress is not None:
+            reader = threading.Thread(target=ffmpeg_line_reader, args=(ffmpeg, progress))
+            reader.daemon = True
+            reader.start()
+
+        stderrReader = None
+        if captureStderr:
+            stderrReader = threading.Thread(target=ffmpeg_stderr_reader, args=(ffmpeg, get_log_job(), stderrLines))
+            stderrReader.daemon = True
+            stderrReader.start()
+
+        loops = 0
+        childCpu = 0.0
+        readBytes = 0
+        writtenBytes = 0
+
+        dashboardId = 0
+        if DASHBOARD.enabled:
+            jobName = get_log_job()
+            dashboardId = DASHBOARD.add(f"{jobName}: {os.path.basename(outFile)}" if jobName
+                                        else os.path.basename(outFile), progress)
 
         while True:
             poll = ffmpeg.poll()
             if poll is not None:
                 break
+
+            if job is not None and job.cancelled.is_set():
+                ffmpeg.kill()
+
+            # can only ask while it's still running, so this misses the last tenth of a second
+            if PROFILER.enabled:
+                try:
+                    cpuTimes = psutil.Process(ffmpeg.pid).cpu_times()
+                    childCpu = cpuTimes.user + cpuTimes.system
+                except psutil.Error:
+                    pass
+
+            # same as the cpu time, the totals so far are all we can get
+            if METRICS.enabled:
+                try:
+                    ioCounters = psutil.Process(ffmpeg.pid).io_counters()
+                    # read_chars includes what came from the page cache, which is most of it with --prefetch
+                    readBytes = getattr(ioCounters, "read_chars", ioCounters.read_bytes)
+                    writtenBytes = getattr(ioCounters, "write_chars", ioCounters.write_bytes)
+                except (psutil.Error, AttributeError):
+                    pass
+
+            # check memory use every second, to learn how much each kind of job needs
+            loops += 1
+            if job is not None and loops % 10 == 0:
+                try:
+                    job.update_memory(ffmpeg.pid, psutil.Process(ffmpeg.pid).memory_info().rss)
+                except psutil.Error:
+                    pass
+
             time.sleep(0.1)
 
+        if job is not None:
+            job.update_memory(ffmpeg.pid, 0)
+
+        DASHBOARD.remove(dashboardId)
+        METRIC_READ_BYTES.inc(readBytes)
+        METRIC_WRITTEN_BYTES.inc(writtenBytes)
+
+        PROFILER.set_arg("output", os.path.basename(outFile))
+        PROFILER.set_arg("child_cpu", childCpu)
+
         # --- do whatever here and then kill process and thread if needed
         # if ffmpeg.poll() is None:  # kill process; will automatically stop thread
         #     ffmpeg.kill()
         #     ffmpeg.wait()
 
-        # if p1 and p1.is_alive():  # wait for thread to finish
-        #     p1.join()
-
-        while False:
-            time.sleep(0.1)
-            # poll = ffmpeg.poll()
-            # if poll is not None:
-            #     break
+        if reader is not None:
+            reader.join()
 
-            lines = ffmpeg.stdout.read(1)
-
-            for line in lines:
-                time.sleep(0.1)
-                ffmpeg_output += line
-
-                if max_size is not None:
-                    continue
-
-                if "size=" in line:
-                    # use the total time range and divide it by ffmpeg's current time in the encode to get a percentage
-                    current_size = line.split("size= ")[1].split(" kB time=")[0].strip()
-                    current_bitrate = line.split("bitrate=")[1].split(" speed=")[0].strip()
-
-                    current_size = int(current_size)
-                    current_bitrate = int(current_bitrate)
-
-                    print("cur size: " + str(current_size))
-
-
-            if max_size is not None and os.path.isfile(outFile):
-                size = os.path.getsize(outFile)
-
-                if size > max_size:
-                    ffmpeg.kill()
-                    print("ASDIHJAIU(WDHJUIO(WDHIUADW")
+        if stderrReader is not None:
+            stderrReader.join()
 
+        remove_cgroup(cgroupPath)
 
     # not working correctly??
     '''
@@ -1144,10 +1902,26 @@ def run_ffmpeg(outFile: str, cmd: List[str], max_size: int = None):
         # p.nice(old_priority)
     '''
     
+    # the job was cancelled, it's not worth a warning
+    if job is not None and job.cancelled.is_set():
+        if os.path.isfile(outFile):
+            os.remove(outFile)
+        return False
+
+    # pipes never have a size, so the exit code is all there is to go on
+    if is_pipe(outFile):
+        return ffmpeg.returncode == 0
+
+    # killed on purpose, don't leave half a clip around
+    if progress is not None and progress.aborted:
+        if os.path.isfile(outFile):
+            os.remove(outFile)
+        return False
+
     # TODO: maybe do a final check for if the video duration is correct?
     if not os.path.isfile(outFile) or os.path.getsize(outFile) == 0:
         # raise Exception("ffmpeg died")
-        warning(f"\n\nffmpeg failed on file: {outFile}\n")
+        warning(f"\n\nffmpeg failed on file: {outFile}\n", *stderrLines)
         return False
     return True
 
@@ -1185,7 +1959,7 @@ def gen_common_cmd(outputVideo: OutputVideo, inputVideo: VideoFile, index: int,
     
     outputName = f"{index}__{os.path.splitext(inputVideo.videoName)[0]}__{timeIndex}"
     
-    if ARGS.encode_raw:
+    if outputVideo.raw:
         outputName = "raw_" + outputName + outputVideo.videoExtRaw
     else:
         outputName += outputVideo.videoExt
@@ -1202,7 +1976,7 @@ def gen_common_cmd(outputVideo: OutputVideo, inputVideo: VideoFile, index: int,
     
     cmd.append(f"-i \"{inputVideo.videoPath}\"")
     
-    if ARGS.encode_raw:
+    if outputVideo.raw:
         if inputVideo.cmdRaw:
             # cmd.append(" ".join(inputVideo.cmdRaw))
             cmd.append(inputVideo.cmdRaw[-1])
@@ -1213,312 +1987,855 @@ def gen_common_cmd(outputVideo: OutputVideo, inputVideo: VideoFile, index: int,
     return outputName, cmd
     
     
-def encode_pass(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
-                timeIndex: int, bitrate: float, isPass2: bool):
+def gen_pass_cmd(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
+                 timeIndex: int, bitrate: float, isPass2: bool, threadArgs: str = "", passLog: str = ""):
     outputName, cmd = gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
 
-    # http://forum.doom9.org/archive/index.php/t-172614.html
-    # only specify bitrate in 2nd pass?
-    # cmd.append(f"-b:v {bitrate}k")
-    # cmd.append(f"-b:v {bitrate}k -maxrate {bitrate + inputVideo.audioBitrate}k")
-    # cmd.append(f"-minrate {bitrate * 1000} -b:v {bitrate * 1000} -maxrate {bitrate + inputVideo.audioBitrate}k")
-    cmd.append(f"-minrate {bitrate * 1000} -maxrate {bitrate * 1000} -b:v {bitrate * 1000}")
-    # cmd.append(f"-bufsize 700K -minrate {bitrate * 1000} -maxrate {bitrate * 1000} -b:v {bitrate * 1000}")
+    passLog = passLog or get_pass_log(outputVideo, inputVideo, timeRange)
+
+    audioCmd = "-an" if outputVideo.use_split_audio() else f"-b:a {inputVideo.audioBitrate}k"
 
     if isPass2:
+        # http://forum.doom9.org/archive/index.php/t-172614.html
+        # only specify bitrate in 2nd pass
+        # cmd.append(f"-b:v {bitrate}k -maxrate {bitrate + inputVideo.audioBitrate}k")
+        # cmd.append(f"-minrate {bitrate * 1000} -b:v {bitrate * 1000} -maxrate {bitrate + inputVideo.audioBitrate}k")
+        cmd.append(f"-minrate {bitrate * 1000} -maxrate {bitrate * 1000} -b:v {bitrate * 1000}")
+        # cmd.append(f"-bufsize 700K -minrate {bitrate * 1000} -maxrate {bitrate * 1000} -b:v {bitrate * 1000}")
         # cmd.append(f"-b:v {bitrate}k -maxrate {bitrate + inputVideo.audioBitrate}k -b:a {inputVideo.audioBitrate}k -pass 2")
-        # cmd.append(f"-b:a {inputVideo.audioBitrate}k -pass 2")
-        cmd.append(f"-b:a {inputVideo.audioBitrate}k")
+        cmd.append(f"{audioCmd} -pass 2 -passlogfile \"{passLog}\"")
         if inputVideo.cmdPass2:
             cmd.append(" ".join(inputVideo.cmdPass2))
+        if threadArgs:
+            cmd.append(threadArgs)
     else:
-        cmd.append(f"-an -pass 1")
+        cmd.append(f"-an -pass 1 -passlogfile \"{passLog}\"")
         if inputVideo.cmdPass1:
             cmd.append(" ".join(inputVideo.cmdPass1))
-        
-    cmd.append(f'\"{outputName}\"')
+        if threadArgs:
+            cmd.append(threadArgs)
+        cmd.append("-f null -")
 
-    if isPass2:
-        # nvm, final bitrate is wildly different, so uh, that's cool
-        run_ffmpeg(outputName, cmd, MAX_FILE_SIZE)
-        # run_ffmpeg(outputName, cmd)
+    return outputName, cmd
+
+
+# the first pass doesn't depend on the bitrate, so the log is cached per source, time range and command,
+# and reused by every retry, size target, and later runs. the source's size and date are in the key too,
+# stats from a different recording with the same name would break the second pass
+def get_pass_log(outputVideo: OutputVideo, inputVideo: VideoFile, timeRange: list) -> str:
+    _, cmd = gen_common_cmd(outputVideo, inputVideo, 0, "", timeRange, 0)
+    cmd.extend(inputVideo.cmdPass1)
+    cmd.append(get_source_cache_key(inputVideo.videoPath))
+    return f"{CACHE_FOLDER}pass1{os.sep}{get_hash(' '.join(cmd))}"
+
+
+PASS_LOG_LOCK = threading.Lock()
+PASS_LOG_LOCKS: Dict[str, threading.Lock] = {}
+
+
+def run_first_pass(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
+                   timeIndex: int, processes: int = 1) -> bool:
+    passLog = get_pass_log(outputVideo, inputVideo, timeRange)
+
+    with PASS_LOG_LOCK:
+        lock = PASS_LOG_LOCKS.setdefault(passLog, threading.Lock())
+
+    # another size target might be running this same first pass right now
+    with lock:
+        passLogFile = passLog + "-0.log"
+        if os.path.isfile(passLogFile) and os.path.getsize(passLogFile) > 0:
+            print(f"\nUsing Cached First Pass: {passLogFile}")
+            return True
+
+        if not os.path.exists(os.path.dirname(passLog)):
+            os.makedirs(os.path.dirname(passLog))
+
+        # the log is written frame by frame, so it only goes in the cache once the whole pass worked,
+        # a cut off log would otherwise get reused forever. some encoders write more files next to it (.mbtree)
+        tempLog = passLog + ".tmp"
+        _, cmd = gen_pass_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, 0, False,
+                              get_thread_args(outputVideo, inputVideo, processes), tempLog)
+        success = run_ffmpeg(tempLog + "-0.log", cmd)
+
+        logFolder, tempName = os.path.split(tempLog)
+        for fileName in os.listdir(logFolder):
+            if not fileName.startswith(tempName + "-0.log"):
+                continue
+
+            tempFile = os.path.join(logFolder, fileName)
+            if success:
+                os.replace(tempFile, passLog + fileName[len(tempName):])
+            else:
+                os.remove(tempFile)
+
+        return success and os.path.isfile(passLogFile)
+
+
+def encode_pass(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
+                timeIndex: int, bitrate: float, extraOutputs: List[str] = None,
+                progress: FFmpegProgress = None) -> Tuple[str, bool]:
+    if not run_first_pass(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex):
+        return "", False
+
+    outputName, cmd = gen_pass_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate, True)
+
+    # nvm, final bitrate is wildly different, so uh, that's cool
+    return run_ffmpeg_segment(outputName, cmd, outputVideo.videoExt, extraOutputs, progress,
+                              get_thread_args(outputVideo, inputVideo))
+
+
+# the full command for encoding one time range, minus the output file and thread args
+def gen_encode_cmd(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
+                   timeIndex: int, bitrate: float):
+    if outputVideo.raw:
+        return gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
+
+    if ARGS.encode_2pass:
+        return gen_pass_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate, True)
+
+    outputName, cmd = gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
+
+    if outputVideo.use_split_audio():
+        cmd.append(f"-b:v {bitrate}k -an")
     else:
-        run_ffmpeg(outputName, cmd)
+        cmd.append(f"-b:v {bitrate}k -b:a {inputVideo.audioBitrate}k")
 
-    return outputName
+    return outputName, cmd
 
 
-def get_file_bitrate(path: str):
-    ffprobe_command = "ffprobe -threads 6 -v error -select_streams v:0 -show_entries format=bit_rate " \
-                      "-of default=noprint_wrappers=1:nokey=1 \"" + path + '"'
+AUDIO_LOCK = threading.Lock()
+AUDIO_LOCKS: Dict[str, threading.Lock] = {}
 
-    output = subprocess.check_output(ffprobe_command, shell=True)
 
-    # clean up the output
-    for line in str(output).split("\\n"):
-        if line.startswith("b\'"):
-            line = line.split("b\'")[1]
-        line = line.split("\\r")[0]
+# audio for one time range, the bitrate never changes between retries so this is only encoded once,
+# and shared with any other output using the same time range and settings
+def encode_audio_clip(outputVideo: OutputVideo, inputVideo: VideoFile, timeRange: list) -> str:
+    _, cmd = gen_common_cmd(outputVideo, inputVideo, 0, "", timeRange, 0)
 
-        if line.endswith("N/A") or line == '\'':
-            continue
+    # the options are written for the whole encode, they can pick the audio codec but can also turn audio off,
+    # which would leave this with nothing to encode
+    if inputVideo.cmd:
+        cmd[-1] = " ".join(option for option in cmd[-1].split(" ") if option != "-an")
+
+    cmd.append(f"-vn -b:a {inputVideo.audioBitrate}k")
+
+    audioFolder = f"{SCRATCH.get_main_root()}audio{os.sep}"
+    audioClip = f"{audioFolder}{get_hash(' '.join(cmd))}{outputVideo.videoExt}"
+
+    with AUDIO_LOCK:
+        lock = AUDIO_LOCKS.setdefault(audioClip, threading.Lock())
+
+    with lock:
+        if os.path.isfile(audioClip) and os.path.getsize(audioClip) > 0:
+            return audioClip
+
+        if not os.path.exists(audioFolder):
+            os.makedirs(audioFolder)
+
+        cmd.append(f'\"{audioClip}\"')
+        return audioClip if run_ffmpeg(audioClip, cmd) else ""
+
+
+# keyframe times in seconds inside a time range, only reads the packets in that range and doesn't decode anything
+@profiled()
+def get_keyframes(inputVideo: VideoFile, timeRange: list) -> List[float]:
+    start = timeRange[0].total_seconds()
+    end = timeRange[1].total_seconds()
+
+    keyframeFolder = f"{CACHE_FOLDER}keyframes{os.sep}"
+    keyframeFile = f"{keyframeFolder}{get_hash(f'{get_source_cache_key(inputVideo.videoPath)}|{start}|{end}')}.txt"
+
+    if os.path.isfile(keyframeFile):
+        with open(keyframeFile, mode="r", encoding="utf-8") as file:
+            return [float(line) for line in file.read().splitlines() if line]
+
+    ffprobe_command = f"ffprobe -v error -select_streams v:0 -read_intervals {start}%{end} " \
+                      f"-show_entries packet=pts_time,flags -of csv=p=0 \"{inputVideo.videoPath}\""
+
+    try:
+        output = subprocess.check_output(ffprobe_command, shell=True, universal_newlines=True)
+    except subprocess.CalledProcessError:
+        print("ffprobe failed getting keyframes, not splitting into chunks")
+        return []
+
+    keyframes = []
+    for line in output.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time != "N/A" and start < float(pts_time) < end:
+            keyframes.append(float(pts_time))
+
+    keyframes.sort()
+
+    write_cache_file(keyframeFile, "\n".join(str(keyframe) for keyframe in keyframes))
+
+    return keyframes
 
-        return float(line)
 
-    return 0.0
+# splits a time range at the scene changes or keyframes closest to every chunk length
+def split_time_range(inputVideo: VideoFile, timeRange: list) -> List[list]:
+    chunkLength = ARGS.chunk_length
+    if chunkLength <= 0 or (timeRange[1] - timeRange[0]).total_seconds() < chunkLength * 2:
+        return [timeRange]
 
+    start = timeRange[0].total_seconds()
+    end = timeRange[1].total_seconds()
+
+    # cutting on a scene change is free, the encoder would start a new keyframe there anyway
+    sceneCuts = SCENE_INDEXER.get_scenes(inputVideo.videoPath, wait=False) or []
+    cutPoints = [cut for cut in sceneCuts if start < cut < end] or get_keyframes(inputVideo, timeRange)
+    if not cutPoints:
+        return [timeRange]
+
+    chunks = []
+    chunkStart = start
+    while end - chunkStart >= chunkLength * 1.5:
+        cutPoint = min(cutPoints, key=lambda point: abs(point - (chunkStart + chunkLength)))
+
+        # no cut point anywhere near where we want one
+        if cutPoint <= chunkStart + chunkLength / 2 or cutPoint >= end - chunkLength / 2:
+            break
+
+        chunks.append([timedelta(seconds=chunkStart), timedelta(seconds=cutPoint)])
+        chunkStart = cutPoint
+
+    chunks.append([timedelta(seconds=chunkStart), timeRange[1]])
+    return chunks
+
+
+# encodes a long time range as chunks in parallel, all at the same bitrate, then joins them without re-encoding
+def encode_chunked(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeRange: list,
+                   timeIndex: int, bitrate: float, chunks: List[list], progress: FFmpegProgress) -> Tuple[str, bool]:
+    outputName, cmd = gen_encode_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate)
+
+    segment = SEGMENT_PLANNER.get_shared(cmd, outputVideo.videoExt)
+
+    if segment is None:
+        return outputName, encode_chunks(outputVideo, inputVideo, index, tempFolder, timeIndex, bitrate, chunks,
+                                         outputName, progress)
+
+    with segment.lock:
+        if segment.encoded:
+            print(f"\nReusing Shared Clip: {segment.path}")
+        else:
+            segment.encoded = encode_chunks(outputVideo, inputVideo, index, tempFolder, timeIndex, bitrate, chunks,
+                                            segment.path, progress)
+
+    return segment.path, segment.encoded
+
+
+def encode_chunks(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str, timeIndex: int,
+                  bitrate: float, chunks: List[list], outputName: str, progress: FFmpegProgress) -> bool:
+    print(f"\nSplitting ({chunks[0][0]} - {chunks[-1][1]}) into {len(chunks)} chunks")
+
+    # the chunks running at once split the job's cpus between them
+    workers = max(1, min(ARGS.chunk_workers, len(chunks)))
+
+    def encode_chunk(chunkIndex: int, chunkRange: list) -> Tuple[str, FFmpegProgress]:
+        if ARGS.encode_2pass:
+            run_first_pass(outputVideo, inputVideo, index, tempFolder, chunkRange, timeIndex, workers)
+
+        _, cmd = gen_encode_cmd(outputVideo, inputVideo, index, tempFolder, chunkRange, timeIndex, bitrate)
+        cmd.append(get_thread_args(outputVideo, inputVideo, workers))
+
+        chunkName = f"{os.path.splitext(outputName)[0]}__chunk{chunkIndex}{outputVideo.videoExt}"
+        chunkDuration = (chunkRange[1] - chunkRange[0]).total_seconds()
+
+        # every chunk gets its share of the clip size window
+        chunkWindow = None
+        if progress.sizeWindow and progress.duration > 0:
+            share = chunkDuration / progress.duration
+            chunkWindow = (progress.sizeWindow[0] * share, progress.sizeWindow[1] * share)
+
+        chunkProgress = FFmpegProgress(chunkDuration, chunkWindow)
+        cmd.append(f'\"{chunkName}\"')
+        run_ffmpeg(chunkName, cmd, chunkProgress)
+        return chunkName, chunkProgress
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(job_thread(lambda args: encode_chunk(*args)), enumerate(chunks)))
+
+    chunkNames = [chunkName for chunkName, _ in results]
+
+    try:
+        # if any chunk was doomed, report the whole clip as aborted with the projected size
+        if any(chunkProgress.aborted for _, chunkProgress in results):
+            progress.aborted = True
+            progress.outTime = progress.duration
+            progress.totalSize = sum(chunkProgress.get_projected_size() if chunkProgress.aborted
+                                     else os.path.getsize(chunkName) for chunkName, chunkProgress in results)
+            progress.bitrate = progress.totalSize * 0.008 / progress.duration
+            return False
+
+        if not all(os.path.isfile(chunkName) and os.path.getsize(chunkName) > 0 for chunkName in chunkNames):
+            return False
+
+        cmd = [
+            "ffmpeg -y -hide_banner",
+            CONCAT_INPUT,
+            "-c copy -map 0",
+            f'\"{outputName}\"',
+        ]
+
+        return run_ffmpeg(outputName, cmd, stdinText=gen_concat_script(chunkNames))
+
+    finally:
+        if not ARGS.keep_temp:
+            for chunkName in chunkNames:
+                if os.path.isfile(chunkName):
+                    os.remove(chunkName)
+
+
+def mux_audio_clips(tempFolder: str, subVideos: List[str], audioClips: List[str], ext: str) -> List[str]:
+    muxedVideos = []
+    for timeIndex, subVideo in enumerate(subVideos):
+        outputName = f"{tempFolder}{os.path.splitext(os.path.basename(subVideo))[0]}__{timeIndex}_av{ext}"
+
+        cmd = [
+            "ffmpeg -y -hide_banner",
+            f"-i \"{subVideo}\"",
+            f"-i \"{audioClips[timeIndex]}\"",
+            "-map 0:v -map 1:a -c copy",
+            f'\"{outputName}\"',
+        ]
+
+        if not run_ffmpeg(outputName, cmd):
+            return []
+
+        muxedVideos.append(outputName)
+
+    return muxedVideos
 
-STATE_NONE = 0
-STATE_SMALLER = 1
-STATE_BIGGER = 2
 
 # Discord Old 8 MB
 # MAX_FILE_SIZE = 8388008
 # MIN_FILE_SIZE = 7602176
 
+BYTES_PER_MB = 1048576
+
 # https://www.gbmb.org/mb-to-bytes
 # Discord 25 MB Update
 MAX_FILE_SIZE = 26214400 # 25 MB
 MIN_FILE_SIZE = 22020096 # 21 MB
 # MIN_FILE_SIZE = 24641536 # 23.5 MB
 
+MAX_ENCODE_ATTEMPTS = 10
+
+# how far off a clip's bitrate can be from what we wanted before it gets encoded again
+CLIP_BITRATE_TOLERANCE = 0.05
+
+
+# shared between every size target of an output, the first one to finish tells the others
+# how far off ffmpeg's bitrate was from what we asked for on each clip, so they start out closer
+class SizeLadder:
+    def __init__(self):
+        self.renditions: List[OutputVideo] = []
+        self.calibration: Dict[int, float] = {}
+
 
 # 2 Pass Encoding
-def encode_input_videos(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str) -> List[str]:
-    if ARGS.encode_raw:
-        return encode_input_videos_raw(outputVideo, inputVideo, index, tempFolder)
-    
-    subVideos = []
-    targetBitrates = outputVideo.calc_target_bitrate()
+@profiled()
+def encode_input_videos(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str,
+                        companion=None) -> List[str]:
+    if outputVideo.raw:
+        return encode_input_videos_raw(outputVideo, inputVideo, index, tempFolder, companion)
+
+    clipCount = len(inputVideo.timeRanges)
+    if clipCount == 0:
+        return []
+
+    outputBitrates = outputVideo.calc_target_bitrate()
+    outputDurations = [duration for video in outputVideo.inputVideos for duration in video.get_duration_list()]
+    inputIndexes = [outputVideo.get_video_index(inputVideo, timeIndex) for timeIndex in range(clipCount)]
+    durations = inputVideo.get_duration_list()
+
+    # the video bitrate we want each clip to end up at, and the bitrate we ask ffmpeg for to get there
+    wantedBitrates = [outputBitrates[inputIndex] for inputIndex in inputIndexes]
+    targetBitrates = wantedBitrates.copy()
+
+    if outputVideo.ladder and outputVideo.ladder.calibration:
+        calibration = outputVideo.ladder.calibration
+        targetBitrates = [bitrate / calibration.get(inputIndexes[t], 1.0) for t, bitrate in enumerate(targetBitrates)]
+
+    # this input only gets its share of the output size window
+    inputBits = sum(bitrate * duration for bitrate, duration in zip(wantedBitrates, durations))
+    inputShare = inputBits / sum(bitrate * duration for bitrate, duration in zip(outputBitrates, outputDurations))
+    minSize = outputVideo.minFileSize * inputShare
+    maxSize = outputVideo.maxFileSize * inputShare
+    goalSize = (minSize + maxSize) / 2
+
+    splitAudio = outputVideo.use_split_audio()
+    audioClips = []
+    audioSize = 0
+
+    if splitAudio:
+        for timeRange in inputVideo.timeRanges:
+            audioClip = encode_audio_clip(outputVideo, inputVideo, timeRange)
+            if not audioClip:
+                return []
+            audioClips.append(audioClip)
+            audioSize += os.path.getsize(audioClip)
+
+    subVideos = [""] * clipCount
+    clipSizes = [0] * clipCount
+    clipBitrates = [0.0] * clipCount  # video only
+    usedBitrates = [0.0] * clipCount
+    accepted = [False] * clipCount
 
-    redo_encode = True
-    count = 0
-    max_count = 10
+    MAX_BITRATE_DEFAULT = 100000000000000000.0
+    max_bitrate = [MAX_BITRATE_DEFAULT] * clipCount
+    min_bitrate = [0.0] * clipCount
 
-    bitrateHistory = [[]] * max_count
-    lastState = STATE_NONE
     prevFileSize = 0
-    stateChanged = False
 
-    MAX_BITRATE_DEFAULT = 100000000000000000.0
-    max_bitrate = [MAX_BITRATE_DEFAULT] * len(targetBitrates)
-    min_bitrate = [0.0] * len(targetBitrates)
+    def encode_clip(timeIndex: int, timeRange: list, bitrate: float, earlyAbort: bool):
+        extraOutputs = companion.take(inputVideo, timeRange) if companion else []
+
+        # kill the encode early if it's clearly going to miss the size this clip should be,
+        # unless it's also writing raw clips, those need to finish
+        sizeWindow = None
+        if earlyAbort and not ARGS.no_early_abort and not extraOutputs:
+            expectedSize = wantedBitrates[timeIndex] * 125 * durations[timeIndex]
+            if not splitAudio:
+                expectedSize += inputVideo.audioBitrate * 125 * durations[timeIndex]
+            sizeWindow = (expectedSize * (1 - EARLY_ABORT_MARGIN), expectedSize * (1 + EARLY_ABORT_MARGIN))
+
+        progress = FFmpegProgress(durations[timeIndex], sizeWindow)
+
+        # chunks are video only, so they need the audio encoded on its own
+        chunks = split_time_range(inputVideo, timeRange) if splitAudio and not extraOutputs else [timeRange]
+
+        if len(chunks) > 1:
+            outputName, success = encode_chunked(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex,
+                                                 bitrate, chunks, progress)
+        elif ARGS.encode_2pass:
+            outputName, success = encode_pass(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex,
+                                              bitrate, extraOutputs, progress)
+        else:
+            outputName, cmd = gen_encode_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate)
+            outputName, success = run_ffmpeg_segment(outputName, cmd, outputVideo.videoExt, extraOutputs, progress,
+                                                     get_thread_args(outputVideo, inputVideo))
 
-    # max_bitrate_mult = [1.0] * len(targetBitrates)
-    # min_bitrate_mult = [1.0] * len(targetBitrates)
-    
-    def encode_loop():
-        nonlocal redo_encode
-        nonlocal count
-        nonlocal lastState
-        nonlocal stateChanged
-        nonlocal prevFileSize
+        return outputName, success, progress
 
+    # don't get stuck in a loop here and only go X times max
+    for attempt in range(MAX_ENCODE_ATTEMPTS):
         for timeIndex, timeRange in enumerate(inputVideo.timeRanges):
-            inputIndex = outputVideo.get_video_index(inputVideo, timeIndex)
-            bitrate = targetBitrates[inputIndex]
-            
-            if ARGS.encode_2pass:
-                outputName = encode_pass(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate, True)
-                # outputName = encode_pass(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate, False)
-                # encode_pass(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex, bitrate, True)
-                
-            else:
-                outputName, cmd = gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
-        
-                cmd.append(f"-b:v {bitrate}k -b:a {inputVideo.audioBitrate}k")
-                cmd.append(f'\"{outputName}\"')
-        
-                if not run_ffmpeg(outputName, cmd):
-                    subVideos.clear()
-                    count = max_count
-                    redo_encode = False
-                    return
-            
-            subVideos.append(outputName)
-            
-        if count >= max_count:
-            return
+            # clips that already hit their bitrate stay on disk
+            if accepted[timeIndex]:
+                continue
 
-        try:
-            totalSize = 0
-            ffmpegBitrateList = []
-            for video in subVideos:
-                if os.path.isfile(video):
-                    totalSize += os.path.getsize(video)
-                    ffmpegBitrateList.append(get_file_bitrate(video) * 0.001)
+            bitrate = targetBitrates[timeIndex]
+            outputName, success, progress = encode_clip(timeIndex, timeRange, bitrate, True)
 
-        except subprocess.CalledProcessError:
-            print("ffprobe failed, skipping")
-            count = max_count
-            redo_encode = False
-            return
+            # use what it got through as the measurement for the next attempt
+            if progress.aborted:
+                clipSizes[timeIndex] = progress.get_projected_size()
+                clipBitrates[timeIndex] = progress.bitrate
+                if not splitAudio:
+                    clipBitrates[timeIndex] = max(clipBitrates[timeIndex] - inputVideo.audioBitrate, 1.0)
 
-        except Exception as F:
-            print(f"exception: {F}")
-            count = max_count
-            redo_encode = False
-            return
+                subVideos[timeIndex] = ""
+                usedBitrates[timeIndex] = bitrate
+                continue
+
+            if not success:
+                return []
+
+            # same as what ffprobe would give for the format bitrate, without launching it for every clip
+            clipSizes[timeIndex] = os.path.getsize(outputName)
+            clipBitrates[timeIndex] = clipSizes[timeIndex] * 0.008 / durations[timeIndex]
+
+            if not splitAudio:
+                clipBitrates[timeIndex] = max(clipBitrates[timeIndex] - inputVideo.audioBitrate, 1.0)
+
+            subVideos[timeIndex] = outputName
+            usedBitrates[timeIndex] = bitrate
+
+        # we know exactly how big the audio is already
+        totalSize = audioSize + sum(clipSizes)
+
+        if minSize <= totalSize <= maxSize and all(subVideos):
+            METRIC_SIZE_ATTEMPTS.observe(attempt + 1)
+            break
 
         if totalSize == prevFileSize:
-            print(f"Attempt {count+1}: well shit, the video is the exact same fucking filesize, actually impossible to encode")
-            count = max_count
-            redo_encode = False
-            return
+            print(f"Attempt {attempt+1}: well shit, the video is the exact same fucking filesize, actually impossible to encode")
+            break
 
-        # https://www.gbmb.org/mb-to-bytes
-        # if above (almost) 8 MB or below 7.25 MB, redo the encode, not good enough
-        # if totalSize > 8388008 or totalSize < 7340032:
-        if totalSize > MAX_FILE_SIZE or totalSize < MIN_FILE_SIZE:
-            print()
-            smaller = totalSize < MIN_FILE_SIZE
-            if smaller:
-                print(f"Attempt {count+1}: Output video is smaller than target file size!!!")
+        prevFileSize = totalSize
+
+        print()
+        if totalSize < minSize:
+            print(f"Attempt {attempt+1}: Output video is smaller than target file size!!!")
+        else:
+            print(f"Attempt {attempt+1}: Output video is larger than target file size!!!")
+
+        # keep the clips that came out close enough to the bitrate we wanted, aborted ones have nothing to keep
+        for t in range(clipCount):
+            if not accepted[t] and subVideos[t] and abs(clipBitrates[t] / wantedBitrates[t] - 1.0) <= CLIP_BITRATE_TOLERANCE:
+                accepted[t] = True
+
+        # every clip did what we asked and it's still off, so the budget is wrong, redo all of them
+        if all(accepted):
+            accepted = [False] * clipCount
+
+        retryClips = [t for t in range(clipCount) if not accepted[t]]
+
+        # give the clips we're redoing whatever is left, keeping their share of it
+        retryBudget = goalSize - audioSize - sum(clipSizes[t] for t in range(clipCount) if accepted[t])
+        if not splitAudio:
+            retryBudget -= sum(inputVideo.audioBitrate * 125 * durations[t] for t in retryClips)
+
+        if retryBudget <= 0:
+            print("  the clips we kept already use up the whole size budget, uh, fuck this")
+            break
+
+        retryBits = sum(wantedBitrates[t] * durations[t] for t in retryClips)
+        print(f"  Keeping {clipCount - len(retryClips)} clip(s), redoing {len(retryClips)} "
+              f"with {retryBudget / BYTES_PER_MB:.2f} MB left")
+
+        for t in retryClips:
+            # bytes to kbit, 1 byte per second is 0.008 kbps
+            wantedBitrates[t] = (retryBudget * (wantedBitrates[t] * durations[t] / retryBits)) * 0.008 / durations[t]
+
+            # how far off ffmpeg was from what we asked for on this clip
+            bitrateMult = clipBitrates[t] / usedBitrates[t]
+            if bitrateMult < 0.2 or bitrateMult > 5:
+                print(f"  CLIP {t}: wait wtf ffmpeg was off by {bitrateMult}x, clamping it")
+                bitrateMult = min(max(bitrateMult, 0.2), 5)
+
+            if clipBitrates[t] > wantedBitrates[t]:
+                max_bitrate[t] = min(max_bitrate[t], usedBitrates[t])
             else:
-                print(f"Attempt {count+1}: Output video is larger than target file size!!!")
-
-            # stateChanged = False
-            if smaller and lastState == STATE_BIGGER:
-                stateChanged = True
-                print(f"  cool we managed to go from being too big to being too small, god ffmpeg why")
-            elif not smaller and lastState == STATE_SMALLER:
-                stateChanged = True
-                print(f"  cool we managed to go from being too small to being too big, god ffmpeg why")
-
-            # reencode videos at an adjusted bitrate based on what ffmpeg felt like encoding it as cause it's DUMB
-            for i, _bitrate in enumerate(targetBitrates):
-                ffmpegBitrate = (ffmpegBitrateList[i])
-
-                if not smaller:
-                    if max_bitrate[i] > _bitrate:
-                        max_bitrate[i] = _bitrate
-                        # max_bitrate_mult[i] = bitrateHistory[count-1][1]
-
-                    bitrateDiv = max(ffmpegBitrate, _bitrate)
-                    bitrateBase = min(ffmpegBitrate, _bitrate)
-                else:
-                    if min_bitrate[i] < _bitrate:
-                        min_bitrate[i] = _bitrate
-                        # min_bitrate_mult[i] = bitrateHistory[count-1][1]
-
-                    bitrateDiv = min(ffmpegBitrate, _bitrate)
-                    bitrateBase = max(ffmpegBitrate, _bitrate)
-
-                # could be something like 0.00017052145616207467, so wtf
-                # maybe clamp it to 0.1 min?
-                bitrateMult = bitrateBase / bitrateDiv
-
-                # TODO: somehow need to make this run in a loop and
-                #  make sure the new bitrate isn't lower than a previous bitrate,
-                #  and lower than a previous bitrate
-
-                # NOTE: could also just store the original bitrate and only use a multiplier on that, idk
-
-                # TODO: also store filesize - if the filesize of a new video is the same as the previous
-                #  just give up i guess lol
-
-                if stateChanged:
-                    targetBitrates[i] = (max_bitrate[i] + min_bitrate[i]) / 2.0
-                    bitrateHistory[count] = [targetBitrates[i], 1.0]
-
-                    print(f"  INPUT {i}: Trying new target bitrate of {targetBitrates[i]}")
-                    print(f"  INPUT {i}: Current Min/Max Bitrates: {min_bitrate[i]}/{max_bitrate[i]}")
-                else:
-                    if bitrateMult < 0.2:
-                        print(f"  INPUT {i}: wait wtf we just calculated a bitrate multiplier below 0.2, clamping to 0.2")
-                        bitrateMult = 0.2
-
-                    targetBitrates[i] = _bitrate * bitrateMult
-
-                    bitrateHistory[count] = [targetBitrates[i], bitrateMult]
-                    print(f"  INPUT {i}: Trying new target bitrate of {targetBitrates[i]}\n    "
-                          f"{_bitrate} * {bitrateMult}  ->  "
-                          f"{_bitrate} * ({bitrateBase} / {bitrateDiv})")
-
-                    if bitrateMult < 0.1:
-                        print(f"  INPUT {i}: wait wtf we just calculated a bitrate multiplier below 0.1, uh, fuck this")
-                        count = max_count
-                        redo_encode = False
-                        break
+                min_bitrate[t] = max(min_bitrate[t], usedBitrates[t])
 
-                    if bitrateMult > 4:
-                        print(f"Bitrate Multiplier is greater than 3, fuck this, it's probably fine")
-                        count = max_count
-                        redo_encode = False
-                        return
+            targetBitrates[t] = wantedBitrates[t] / bitrateMult
 
-                    if targetBitrates[i] <= 0.01:
-                        print(f"  INPUT {i}: wtf we just calculated a bitrate of 0.01 or below, uh, fuck this")
-                        count = max_count
-                        redo_encode = False
-                        break
+            # the guess went past a bitrate we already know is too big or small, so split the difference
+            if max_bitrate[t] != MAX_BITRATE_DEFAULT and not min_bitrate[t] < targetBitrates[t] < max_bitrate[t]:
+                targetBitrates[t] = (max_bitrate[t] + min_bitrate[t]) / 2.0
 
-                # if count > 0:
-                #     print(f"  INPUT {i}: Previous bitrate: {bitrateHistory[count-1][0]}")
+            print(f"  CLIP {t}: Trying new target bitrate of {targetBitrates[t]}\n    "
+                  f"wanted {wantedBitrates[t]}, got {clipBitrates[t]} from {usedBitrates[t]}, "
+                  f"min/max {min_bitrate[t]}/{max_bitrate[t]}")
 
-            lastState = STATE_SMALLER if smaller else STATE_BIGGER
-            prevFileSize = totalSize
-            subVideos.clear()
+        if any(targetBitrates[t] <= 0.01 for t in retryClips):
+            print("  wtf we just calculated a bitrate of 0.01 or below, uh, fuck this")
+            break
 
-        else:
-            count = max_count
-            redo_encode = False
+    else:
+        print(f"HIT MAX RETRY COUNT OF {MAX_ENCODE_ATTEMPTS}, SKIPPING VIDEO")
+        METRIC_SIZE_ATTEMPTS.observe(MAX_ENCODE_ATTEMPTS)
+        return []
+
+    # the loop gave up with clips that got aborted on the last attempt, finish them at the bitrate they were
+    # aborted at, so the output is at least complete, even if it misses the size
+    for t in range(clipCount):
+        if subVideos[t]:
+            continue
 
-    # don't get stuck in a loop here and only go X times max
-    while redo_encode and count < max_count:
-        encode_loop()
-        count += 1
+        print(f"  CLIP {t}: got aborted on the last attempt, finishing it at {usedBitrates[t]}")
+        outputName, success, _ = encode_clip(t, inputVideo.timeRanges[t], usedBitrates[t], False)
+        if not success:
+            return []
+
+        subVideos[t] = outputName
+
+    if outputVideo.ladder:
+        for t in range(clipCount):
+            outputVideo.ladder.calibration[inputIndexes[t]] = clipBitrates[t] / usedBitrates[t]
 
-    if count == max_count:
-        print(f"HIT MAX RETRY COUNT OF {max_count}, SKIPPING VIDEO")
+    if splitAudio:
+        return mux_audio_clips(tempFolder, subVideos, audioClips, outputVideo.videoExt)
     
     return subVideos
 
 
-def encode_input_videos_raw(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str) -> List[str]:
+def encode_input_videos_raw(outputVideo: OutputVideo, inputVideo: VideoFile, index: int, tempFolder: str,
+                            companion=None) -> List[str]:
     subVideos = []
     
     for timeIndex, timeRange in enumerate(inputVideo.timeRanges):
+        # already written alongside the normal encode of this time range
+        if companion and companion.has_clip(index, timeIndex):
+            subVideos.append(companion.get_clip(index, timeIndex))
+            continue
+
         outputName, cmd = gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
-        
-        cmd.append(f'\"{outputName}\"')
-        
-        run_ffmpeg(outputName, cmd)
+        outputName, _ = run_ffmpeg_segment(outputName, cmd, outputVideo.videoExtRaw)
         subVideos.append(outputName)
     
     return subVideos
 
 
-def create_output_video(tempFolder: str, subVideoList: List[str], outputVideo: OutputVideo):
-    if len(subVideoList) == 0:
-        warning("No Input Videos in Output Video, Skipping")
-        return
-    
-    # stuff for ffmpeg concat shit
-    concatFile = tempFolder + "concat.txt"
-    with open(concatFile, "w", encoding="utf-8") as temp_file_io:
-        for sub_video in subVideoList:
-            temp_file_io.write("file '" + sub_video + "'\n")
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        self.refCount = 0
+        self.encoded = False
+        self.lock = threading.Lock()
 
-    # outputVideo.write_metadata()
-            
-    metadata = outputVideo.get_metadata_cmd()
 
-    metadata_inputs = []
+# finds clips that are encoded with the exact same command more than once across all output videos,
+# so they only get encoded once and all the outputs that use them can share the file
+class SegmentPlanner:
+    def __init__(self):
+        self.folder = f"{SCRATCH.get_main_root()}segments{os.sep}"
+        self.segments: Dict[str, Segment] = {}
+        self.outputKeys: Dict[str, List[str]] = {}  # output key -> segment keys, normal and raw outputs share a path
+        self.releasedKeys: Dict[str, List[str]] = {}  # same, for outputs that are done, in case verification fails
+        self.lock = threading.Lock()
 
-    # HACK HACK METADATA INPUT FILE
-    index = 0
-    while index < len(metadata):
-        if metadata[index].startswith("-i"):
-            metadata_inputs.append(metadata[index])
-            metadata.remove(metadata[index])
+    @staticmethod
+    def get_key(cmd: List[str], ext: str) -> str:
+        return get_hash(" ".join(cmd) + ext)
+
+    def plan(self, video_list: List[OutputVideo]):
+        for outputVideo in video_list:
+            if outputVideo.skip or not ARGS.encode or outputVideo.get_duration() == 0:
+                continue
+
+            ext = outputVideo.videoExtRaw if outputVideo.raw else outputVideo.videoExt
+            targetBitrates = [] if outputVideo.raw else outputVideo.calc_target_bitrate()
+            keys = self.outputKeys.setdefault(get_output_key(outputVideo), [])
+            self.releasedKeys.pop(get_output_key(outputVideo), None)
+
+            for index, inputVideo in enumerate(outputVideo.inputVideos):
+                for timeIndex, timeRange in enumerate(inputVideo.timeRanges):
+                    # retries use a different bitrate, so only the first attempt can be planned for
+                    bitrate = 0 if outputVideo.raw else targetBitrates[outputVideo.get_video_index(inputVideo, timeIndex)]
+                    _, cmd = gen_encode_cmd(outputVideo, inputVideo, index, "", timeRange, timeIndex, bitrate)
+
+                    key = self.get_key(cmd, ext)
+                    if key not in self.segments:
+                        self.segments[key] = Segment(f"{self.folder}{key}{ext}")
+
+                    self.segments[key].refCount += 1
+                    keys.append(key)
+
+        shared = [segment for segment in self.segments.values() if segment.refCount > 1]
+        if shared:
+            print_color(Color.CYAN, f"Shared Clips: {len(shared)}, "
+                                    f"saving {sum(segment.refCount - 1 for segment in shared)} encodes")
+
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+
+    # returns the segment if more than one clip uses this command
+    def get_shared(self, cmd: List[str], ext: str):
+        segment = self.segments.get(self.get_key(cmd, ext))
+        if segment is None or segment.refCount <= 1:
+            return None
+        return segment
+
+    # call once an output video is done with its clips, deletes shared clips nothing else needs anymore
+    def release_output(self, outputVideo: OutputVideo):
+        with self.lock:
+            keys = self.outputKeys.pop(get_output_key(outputVideo), [])
+            self.releasedKeys[get_output_key(outputVideo)] = keys
+
+            for key in keys:
+                segment = self.segments[key]
+                segment.refCount -= 1
+
+                if segment.refCount > 0 or ARGS.keep_temp:
+                    continue
+
+                # the next --watch pass might plan it again, and has to encode it again
+                self.remove_segment(segment)
+
+    # the output failed verification, so any shared clip it used might be the broken part.
+    # they all get encoded again, and the output doesn't share them anymore
+    def invalidate_output(self, outputVideo: OutputVideo):
+        with self.lock:
+            keys = self.releasedKeys.pop(get_output_key(outputVideo), [])
+            for key in self.outputKeys.pop(get_output_key(outputVideo), []):
+                self.segments[key].refCount -= 1
+                keys.append(key)
+
+            for key in keys:
+                with self.segments[key].lock:
+                    self.remove_segment(self.segments[key])
+
+    @staticmethod
+    def remove_segment(segment: Segment):
+        segment.encoded = False
+
+        try:
+            if os.path.isfile(segment.path):
+                os.remove(segment.path)
+        except Exception as F:
+            print(f"Failed to delete shared clip {segment.path} - {F}")
+
+
+# extraOutputs are more outputs for the same ffmpeg process, only written if this clip actually gets encoded.
+# threadArgs go on after looking up the shared clip, the planner doesn't know which job will encode it
+def run_ffmpeg_segment(outputName: str, cmd: List[str], ext: str, extraOutputs: List[str] = None,
+                       progress: FFmpegProgress = None, threadArgs: str = "") -> Tuple[str, bool]:
+    segment = SEGMENT_PLANNER.get_shared(cmd, ext)
+
+    if threadArgs:
+        cmd = cmd + [threadArgs]
+
+    if segment is None:
+        cmd.append(f'\"{outputName}\"')
+        cmd.extend(extraOutputs or [])
+        return outputName, run_ffmpeg(outputName, cmd, progress)
+
+    with segment.lock:
+        if segment.encoded:
+            print(f"\nReusing Shared Clip: {segment.path}")
         else:
+            cmd.append(f'\"{segment.path}\"')
+            cmd.extend(extraOutputs or [])
+            segment.encoded = run_ffmpeg(segment.path, cmd, progress)
+
+    return segment.path, segment.encoded
+
+
+# raw clips that get written by the same ffmpeg process as the normal encode of the same time range,
+# so the source is only read once for both, instead of once per pass
+class RawCompanion:
+    def __init__(self, rawOutput: OutputVideo, tempFolder: str):
+        self.rawOutput = rawOutput
+        self.clips: Dict[Tuple[int, int], str] = {}
+        self.pending: Dict[Tuple[str, str, str], Dict[str, str]] = {}
+
+        for index, inputVideo in enumerate(rawOutput.inputVideos):
+            for timeIndex, timeRange in enumerate(inputVideo.timeRanges):
+                clipName, cmd = gen_common_cmd(rawOutput, inputVideo, index, tempFolder, timeRange, timeIndex)
+
+                # shared clips are left to the raw output's own encode, which holds the clip's lock while writing it.
+                # two normal encodes with different settings could both be writing it here otherwise
+                if SEGMENT_PLANNER.get_shared(cmd, rawOutput.videoExtRaw) is not None:
+                    continue
+
+                # only the output options, the input is shared with the normal encode
+                rangeKey = (inputVideo.videoPath, str(timeRange[0]), str(timeRange[1]))
+                self.pending.setdefault(rangeKey, {})[clipName] = inputVideo.cmdRaw[-1] if inputVideo.cmdRaw else ""
+                self.clips[(index, timeIndex)] = clipName
+
+    # output args for every raw clip of this time range that isn't written yet
+    def take(self, inputVideo: VideoFile, timeRange: list) -> List[str]:
+        extraOutputs = []
+        for clipName, rawOptions in self.pending.pop((inputVideo.videoPath, str(timeRange[0]), str(timeRange[1])), {}).items():
+            extraOutputs.extend([rawOptions, f'\"{clipName}\"'])
+        return extraOutputs
+
+    def has_clip(self, index: int, timeIndex: int) -> bool:
+        clipName = self.clips.get((index, timeIndex))
+        return bool(clipName) and os.path.isfile(clipName) and os.path.getsize(clipName) > 0
+
+    def get_clip(self, index: int, timeIndex: int) -> str:
+        return self.clips[(index, timeIndex)]
+
+
+# deletes clips the concat has already read past, so the scratch folder never has to fit every clip and the output
+def delete_consumed_clips(progress: FFmpegProgress, done: threading.Event, tempFolder: str, clips: List[str],
+                          durations: List[float]):
+    clipEnd = 0.0
+    index = 0
+
+    while index < len(clips) and not done.wait(0.5):
+        # a second of slack, the output time runs a little behind what the demuxer has read
+        while index < len(clips) and progress.outTime > clipEnd + durations[index] + 1.0:
+            clipEnd += durations[index]
+
+            # shared segments live outside the temp folder and might still be needed by another output
+            if clips[index].startswith(tempFolder):
+                try:
+                    os.remove(clips[index])
+                except OSError:
+                    # still open on windows, it gets deleted with the temp folder later anyway
+                    pass
+
             index += 1
 
+
+# streams every raw clip straight into the final concat through named pipes, so none of them touch the disk.
+# the clips are written one at a time, the concat blocks on opening the next pipe until it's being written to
+class RawPipes:
+    def __init__(self, outputVideo: OutputVideo, tempFolder: str):
+        self.pipes: List[str] = []
+        self.cmds: List[List[str]] = []
+        self.durations: List[float] = []
+        self.stopped = False
+        self.failed = False
+        self.thread = None
+
+        for index, inputVideo in enumerate(outputVideo.inputVideos):
+            for timeIndex, timeRange in enumerate(inputVideo.timeRanges):
+                outputName, cmd = gen_common_cmd(outputVideo, inputVideo, index, tempFolder, timeRange, timeIndex)
+
+                # nut doesn't need to seek back to write a header, and can hold about anything mkv can
+                pipe = os.path.splitext(outputName)[0] + ".nut"
+
+                # left over from an earlier run with -k, or the first try at this output
+                if os.path.lexists(pipe):
+                    os.remove(pipe)
+                os.mkfifo(pipe)
+                cmd.append(f"-f nut \"{pipe}\"")
+
+                self.pipes.append(pipe)
+                self.cmds.append(cmd)
+                self.durations.append(inputVideo.get_duration_range(timeIndex))
+
+    @staticmethod
+    def is_supported(outputVideo: OutputVideo, companion) -> bool:
+        # clips shared with the normal output are already written by it
+        return ARGS.raw_pipes and outputVideo.raw and companion is None and hasattr(os, "mkfifo")
+
+    def start(self):
+        self.thread = threading.Thread(target=job_thread(self.run))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        for pipe, cmd in zip(self.pipes, self.cmds):
+            if self.stopped:
+                break
+            if not run_ffmpeg(pipe, cmd):
+                self.failed = True
+
+    def finish(self) -> bool:
+        self.stopped = True
+
+        # if the concat died early, a clip can still be stuck waiting for something to open its pipe
+        while self.thread is not None and self.thread.is_alive():
+            for pipe in self.pipes:
+                try:
+                    os.close(os.open(pipe, os.O_RDONLY | os.O_NONBLOCK))
+                except OSError:
+                    pass
+            self.thread.join(0.5)
+
+        return not self.failed
+
+
+@profiled()
+def create_output_video(tempFolder: str, subVideoList: List[str], outputVideo: OutputVideo,
+                        clipDurations: List[float] = None, piped: bool = False) -> bool:
+    if len(subVideoList) == 0:
+        warning("No Input Videos in Output Video, Skipping")
+        return False
+
+    # -c copy just makes a broken video out of clips that don't match, pipes can't be checked ahead of time though
+    if VERIFIER.enabled and not piped:
+        reason = check_concat_params(subVideoList)
+        if reason:
+            warning(f"\n\nCan't combine the clips for {outputVideo.get_video_path()}: {reason}\n")
+            return False
+
+    # pipes can't be probed for their length ahead of time
+    script = gen_concat_script(subVideoList, clipDurations if piped else None,
+                               [pos for _, pos in outputVideo.get_chapters()])
+
+    # outputVideo.write_metadata()
+    metadata = outputVideo.get_metadata_cmd()
+
     cmd = [
         "ffmpeg -y -hide_banner",
-        "-safe 0 -f concat -i \"" + concatFile + '"',
-        *metadata_inputs,
+        CONCAT_INPUT,
         "-c copy -map 0",
         *metadata,
         f"\"{outputVideo.get_video_path()}\"",
@@ -1526,10 +2843,26 @@ def create_output_video(tempFolder: str, subVideoList: List[str], outputVideo: O
     
     if not os.path.exists(outputVideo.get_video_dir()):
         os.makedirs(outputVideo.get_video_dir())
-    
-    if not run_ffmpeg(outputVideo.get_video_path(), cmd):
-        os.remove(concatFile)
-        return
+
+    progress = None
+    deleter = None
+    deleterDone = threading.Event()
+
+    if clipDurations and len(clipDurations) == len(subVideoList) and not ARGS.keep_temp and not piped:
+        progress = FFmpegProgress(sum(clipDurations))
+        deleter = threading.Thread(target=delete_consumed_clips,
+                                   args=(progress, deleterDone, tempFolder, subVideoList, clipDurations))
+        deleter.daemon = True
+        deleter.start()
+
+    success = run_ffmpeg(outputVideo.get_video_path(), cmd, progress, script)
+
+    if deleter is not None:
+        deleterDone.set()
+        deleter.join()
+
+    if not success:
+        return False
     
     if outputVideo.dateFile:
         date_created = get_date_created(outputVideo.dateFile)
@@ -1540,9 +2873,9 @@ def create_output_video(tempFolder: str, subVideoList: List[str], outputVideo: O
         
         if ARGS.verbose:
             print("Set Date Created, Modified, and Accessed")
-    
-    os.remove(concatFile)
-    
+
+    return True
+
 
 def delete_temp_folder(tempFolder: str):
     if ARGS.keep_temp:
@@ -1562,72 +2895,818 @@ def write_hash_file(video_name, hashList: List[str]):
         os.makedirs(hashPath)
         
     hashPath += os.sep + video_name + ".hash"
-    with open(hashPath, mode="w", encoding="utf-8") as hashFile:
-        hashFile.write("\n".join(hashList))
+    with HASH_LOCK:
+        with open(hashPath, mode="w", encoding="utf-8") as hashFile:
+            hashFile.write("\n".join(hashList))
+        HASH_FILES[video_name] = list(hashList)
     return
 
 
+MOVE_LOCK = threading.Lock()
+
+
+@profiled()
 def move_video_check(outputVideo: OutputVideo):
     if VIDEO_CONFIG.moveFolder and ARGS.move_files:
-        for index, inputVideo in enumerate(outputVideo.inputVideos):
-            # remove from queue
-            ALL_INPUT_VIDEOS.remove(inputVideo.videoPath)
+        with MOVE_LOCK:
+            for index, inputVideo in enumerate(outputVideo.inputVideos):
+                # remove from queue
+                ALL_INPUT_VIDEOS.remove(inputVideo.videoPath)
 
-            # if video isn't used again later, then we can safely move it
-            if inputVideo.videoPath not in ALL_INPUT_VIDEOS:
-                move_video(outputVideo, inputVideo)
+                # if video isn't used again later, then we can safely move it
+                if inputVideo.videoPath not in ALL_INPUT_VIDEOS:
+                    move_video(outputVideo, inputVideo)
 
 
-def run_encoding():
-    if not os.path.exists(TEMP_FOLDER):
-        os.makedirs(TEMP_FOLDER)
-    
-    print_timestamps(VIDEO_CONFIG.videoList)
-    
-    for outputVideo in VIDEO_CONFIG.videoList:
-        if outputVideo.skip or not ARGS.encode:
-            move_video_check(outputVideo)
-            continue
+# outputs in different folders can have the same name, so the full path gets hashed in too
+def get_temp_name(outputVideo: OutputVideo) -> str:
+    tempName = f"{os.path.splitext(outputVideo.videoName)[0]}_{get_hash(outputVideo.videoPath)[:8]}"
+    if outputVideo.raw:
+        tempName = "raw_" + tempName
+    return tempName
+
+
+# rough size of everything an output puts in its temp folder, with some room for retries and chunks
+def estimate_temp_size(outputVideo: OutputVideo) -> int:
+    if outputVideo.raw:
+        size = sum(inputVideo.get_duration() * inputVideo.origInfo["bitrate"] / 8 for inputVideo in outputVideo.inputVideos)
+    else:
+        size = outputVideo.maxFileSize
+    return int(size * 1.5)
+
+
+# reserves space for the output in whichever scratch folder has room, until encode_output_video is done with it
+def get_temp_folder(outputVideo: OutputVideo) -> str:
+    tempName = get_temp_name(outputVideo)
+    return SCRATCH.reserve(tempName, estimate_temp_size(outputVideo)) + tempName + os.sep
 
-        print(cmd_bar_line)
-        print_color(Color.CYAN, f"Output Video: {outputVideo.get_video_path()}")
 
-        tempFolder = TEMP_FOLDER + os.path.splitext(outputVideo.videoName)[0] + os.sep
-        if not os.path.exists(tempFolder):
-            os.makedirs(tempFolder)
+def prepare_temp_folder(tempFolder: str):
+    if not os.path.exists(tempFolder):
+        os.makedirs(tempFolder)
+    else:
+        # print("Deleting old TEMP Folder: " + tempFolder)
+        delete_temp_folder(tempFolder)
+
+
+@profiled()
+def encode_output_video(outputVideo: OutputVideo, tempFolder: str, companion: RawCompanion = None):
+    print(cmd_bar_line)
+    print_color(Color.CYAN, f"Output Video: {outputVideo.get_video_path()}")
+
+    startTime = time.perf_counter()
+
+    subVideoList: List[str] = []
+    clipDurations: List[float] = []
+
+    if RawPipes.is_supported(outputVideo, companion):
+        rawPipes = RawPipes(outputVideo, tempFolder)
+        rawPipes.start()
+        success = create_output_video(tempFolder, rawPipes.pipes, outputVideo, rawPipes.durations, True)
+
+        if rawPipes.finish():
+            clipDurations = rawPipes.durations
         else:
-            # print("Deleting old TEMP Folder: " + tempFolder)
-            delete_temp_folder(tempFolder)
-        
-        subVideoList: List[str] = []
+            # the concat just sees a clip end early, so the output is missing parts of it
+            warning(f"\n\nffmpeg failed streaming clips for: {outputVideo.get_video_path()}\n")
+            if os.path.isfile(outputVideo.get_video_path()):
+                os.remove(outputVideo.get_video_path())
+            success = False
+
+    else:
         for index, inputVideo in enumerate(outputVideo.inputVideos):
             print("\nInput: " + inputVideo.videoName)
 
-            subVideoList.extend(encode_input_videos(outputVideo, inputVideo, index, tempFolder))
-            
+            subVideos = encode_input_videos(outputVideo, inputVideo, index, tempFolder, companion)
+            subVideoList.extend(subVideos)
+
+            # one clip per time range, unless the input got skipped
+            if subVideos:
+                clipDurations.extend(inputVideo.get_duration_list())
+
         # now combine all the sub videos together
-        create_output_video(tempFolder, subVideoList, outputVideo)
-        # print("\nDeleting TEMP Folder: " + tempFolder)
+        success = create_output_video(tempFolder, subVideoList, outputVideo, clipDurations)
+
+    SEGMENT_PLANNER.release_output(outputVideo)
+    # print("\nDeleting TEMP Folder: " + tempFolder)
+
+    try:
+        if not ARGS.keep_temp:
+            delete_temp_folder(tempFolder)  # useless if im doing rmtree below?
+            shutil.rmtree(tempFolder)
+    except Exception as F:
+        print("Failed to delete temp folder - " + str(F))
+
+    SCRATCH.release(get_temp_name(outputVideo))
+
+    if not success:
+        METRIC_JOBS.inc(result="failed")
+        return
+
+    encodeTime = time.perf_counter() - startTime
+    METRIC_JOBS.inc(result="completed")
+    METRIC_ENCODE_SECONDS.observe(encodeTime)
+    METRIC_SPEED.observe(outputVideo.get_duration() / encodeTime)
+
+    SPEED_HISTORY.add(outputVideo, encodeTime)
+    VERIFIER.submit(outputVideo)
+
+
+def finish_output_video(outputVideo: OutputVideo):
+    # write_hash_file(os.path.basename(outputVideo.get_video_name()), outputVideo.hashList)
+    write_hash_file(get_hash(outputVideo.get_video_path()), outputVideo.hashList)
+
+    # move inputs to "move" folder
+    move_video_check(outputVideo)
+
+
+# the first size target is encoded on its own to calibrate the bitrates, then the rest run in parallel
+def encode_size_ladder(ladder: SizeLadder):
+    renditions = [rendition for rendition in ladder.renditions if not rendition.skip]
+    threads = []
+    job = get_job()
+
+    for index, rendition in enumerate(renditions):
+        tempFolder = get_temp_folder(rendition)
+        prepare_temp_folder(tempFolder)
+
+        if index == 0:
+            encode_output_video(rendition, tempFolder)
+            if job is not None:
+                job.parallel = len(renditions) - 1
+            continue
+
+        thread = threading.Thread(target=job_thread(encode_output_video), args=(rendition, tempFolder))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if job is not None:
+        job.parallel = 1
+
+
+# ==================================================================================================
+# Output Verification
+# ==================================================================================================
+
+
+# has to match between clips for -c copy to make a working video out of them
+CONCAT_PARAMS = ["codec_type", "codec_name", "profile", "width", "height", "pix_fmt", "sample_rate", "channels"]
+
+
+# the container duration and streams of a file, counting packets only reads them, nothing gets decoded
+def probe_streams(path: str, countPackets: bool = False) -> Tuple[float, List[Dict[str, str]]]:
+    entries = ",".join(CONCAT_PARAMS + ["avg_frame_rate", "nb_read_packets"])
+    ffprobe_command = f"ffprobe -v error {'-count_packets ' if countPackets else ''}" \
+                      f"-show_entries format=duration:stream={entries} \"{path}\""
+
+    output = subprocess.check_output(ffprobe_command, shell=True, universal_newlines=True)
+
+    duration = 0.0
+    streams: List[Dict[str, str]] = []
+    stream = None
+
+    for line in output.splitlines():
+        if line == "[STREAM]":
+            stream = {}
+            streams.append(stream)
+        elif line == "[FORMAT]":
+            stream = None
+        elif not line.startswith("[/"):
+            key, _, value = line.partition("=")
+            if stream is not None:
+                stream[key] = value
+            elif key == "duration" and value != "N/A":
+                duration = float(value)
+
+    return duration, streams
+
+
+# returns why the clips can't be concatenated, or an empty string if they can
+@profiled()
+def check_concat_params(clips: List[str]) -> str:
+    if len(clips) < 2:
+        return ""
 
+    firstClip = ""
+    firstParams = []
+
+    for clip in clips:
+        try:
+            _, streams = probe_streams(clip)
+        except subprocess.CalledProcessError:
+            return f"ffprobe couldn't read {os.path.basename(clip)}"
+
+        params = [[stream.get(key, "") for key in CONCAT_PARAMS] for stream in streams]
+
+        if not firstClip:
+            firstClip = clip
+            firstParams = params
+        elif params != firstParams:
+            return f"{os.path.basename(clip)} has different stream settings than {os.path.basename(firstClip)}"
+
+    return ""
+
+
+# checks finished outputs in the background while the next ones encode,
+# the hash only gets written once it passes, and the ones that don't get redone at the end
+class OutputVerifier:
+    def __init__(self):
+        self.enabled = not ARGS.no_verify
+        self.executor = None
+        self.futures: List[concurrent.futures.Future] = []
+        self.failed: List[OutputVideo] = []
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, ARGS.verify_workers))
+
+    def submit(self, outputVideo: OutputVideo):
+        if not self.enabled:
+            finish_output_video(outputVideo)
+            return
+
+        # checked against every time range in the config, an input that got dropped makes the output too short
+        clipCount = sum(len(inputVideo.timeRanges) for inputVideo in outputVideo.inputVideos)
+        future = self.executor.submit(self.verify, outputVideo, outputVideo.get_duration(), clipCount)
+        with self.lock:
+            self.futures.append(future)
+
+    def verify(self, outputVideo: OutputVideo, expectedDuration: float, clipCount: int):
         try:
-            if not ARGS.keep_temp:
-                delete_temp_folder(tempFolder)  # useless if im doing rmtree below?
-                shutil.rmtree(tempFolder)
+            reason = self.check(outputVideo, expectedDuration, clipCount)
         except Exception as F:
-            print("Failed to delete temp folder - " + str(F))
-            
-        if len(subVideoList) == 0:
+            reason = str(F)
+
+        if not reason:
+            if ARGS.verbose:
+                print(f"Verified Output Video: {outputVideo.get_video_path()}")
+            finish_output_video(outputVideo)
+            return
+
+        warning(f"\n\nOutput Video failed verification: {outputVideo.get_video_path()}\n  {reason}\n")
+
+        if os.path.isfile(outputVideo.get_video_path()):
+            os.remove(outputVideo.get_video_path())
+
+        with self.lock:
+            self.failed.append(outputVideo)
+
+    # returns what's wrong with the output, or an empty string if nothing is
+    @staticmethod
+    @profiled()
+    def check(outputVideo: OutputVideo, expectedDuration: float, clipCount: int) -> str:
+        try:
+            duration, streams = probe_streams(outputVideo.get_video_path(), True)
+        except subprocess.CalledProcessError:
+            return "ffprobe couldn't read it"
+
+        if not any(stream.get("codec_type") == "video" for stream in streams):
+            return "no video stream"
+
+        for index, stream in enumerate(streams):
+            if not stream.get("nb_read_packets", "0").isdigit() or int(stream.get("nb_read_packets", "0")) == 0:
+                return f"{stream.get('codec_type', 'unknown')} stream {index} is empty"
+
+        # stream copied clips start on the keyframe before the timestamp, so they can each run a bit long
+        tolerance = max(1.0, expectedDuration * 0.01)
+        if outputVideo.raw:
+            tolerance += clipCount * 0.5
+
+        if abs(duration - expectedDuration) > tolerance:
+            return f"it's {duration:.2f} seconds long, should be {expectedDuration:.2f}"
+
+        # the container is as long as its longest stream, so a video stream cut short next to
+        # full length audio only shows up in how many frames it has
+        video = next(stream for stream in streams if stream.get("codec_type") == "video")
+        fps0, _, fps1 = video.get("avg_frame_rate", "0/0").partition("/")
+        if fps0.isdigit() and fps1.isdigit() and int(fps0) and int(fps1):
+            fps = int(fps0) / int(fps1)
+            frames = int(video["nb_read_packets"])
+            if frames < (expectedDuration - tolerance) * fps:
+                return f"the video stream has {frames} frames, should be about {expectedDuration * fps:.0f}"
+
+        return ""
+
+    # waits for everything submitted so far, and returns the outputs that failed
+    def wait(self) -> List[OutputVideo]:
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+
+        concurrent.futures.wait(futures)
+
+        with self.lock:
+            failed = self.failed
+            self.failed = []
+
+        return failed
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+# ==================================================================================================
+# Job Scheduling
+# ==================================================================================================
+
+
+# how long past encodes took, in seconds per million pixels of video, per encode command
+class SpeedHistory:
+    # rough guesses for before we've encoded anything with a command
+    DEFAULT_SPEED = 0.02
+    DEFAULT_SPEED_RAW = 0.0005
+
+    def __init__(self):
+        self.path = f"{CACHE_FOLDER}speed_history.txt"
+        self.speeds: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, mode="r", encoding="utf-8") as file:
+                for line in file.read().splitlines():
+                    key, _, speed = line.partition(" ")
+                    if speed:
+                        self.speeds[key] = float(speed)
+
+    @staticmethod
+    def get_key(outputVideo: OutputVideo) -> str:
+        settings = ""
+        if outputVideo.inputVideos:
+            cmd = outputVideo.inputVideos[0].cmdRaw if outputVideo.raw else outputVideo.inputVideos[0].cmd
+            settings = cmd[-1] if cmd else ""
+        return get_hash(f"{outputVideo.raw}|{settings}")
+
+    @staticmethod
+    def get_megapixels(outputVideo: OutputVideo) -> float:
+        return sum(inputVideo.get_duration() * inputVideo.origInfo["width"] * inputVideo.origInfo["height"] *
+                   inputVideo.origInfo["fps"] for inputVideo in outputVideo.inputVideos) / 1000000
+
+    def get_speed(self, outputVideo: OutputVideo) -> float:
+        default = self.DEFAULT_SPEED_RAW if outputVideo.raw else self.DEFAULT_SPEED
+        return self.speeds.get(self.get_key(outputVideo), default)
+
+    # estimated seconds to encode
+    def get_cost(self, outputVideo: OutputVideo) -> float:
+        return self.get_megapixels(outputVideo) * self.get_speed(outputVideo)
+
+    def add(self, outputVideo: OutputVideo, seconds: float):
+        megapixels = self.get_megapixels(outputVideo)
+        if megapixels <= 0:
+            return
+
+        key = self.get_key(outputVideo)
+        speed = seconds / megapixels
+
+        with self.lock:
+            # lean towards recent runs, ffmpeg or the machine might have changed
+            self.speeds[key] = speed if key not in self.speeds else self.speeds[key] * 0.5 + speed * 0.5
+
+    def save(self):
+        with self.lock:
+            write_cache_file(self.path, "\n".join(f"{key} {speed}" for key, speed in self.speeds.items()))
+
+
+# peak memory past encodes used in bytes, per encode command and resolution
+class MemoryHistory:
+    # rough guess for before we've encoded anything with a command
+    DEFAULT_MEMORY = 512 * BYTES_PER_MB
+
+    def __init__(self):
+        self.path = f"{CACHE_FOLDER}memory_history.txt"
+        self.memory: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+        if os.path.isfile(self.path):
+            with open(self.path, mode="r", encoding="utf-8") as file:
+                for line in file.read().splitlines():
+                    key, _, memory = line.partition(" ")
+                    if memory:
+                        self.memory[key] = int(memory)
+
+    # memory use depends on the resolution way more than the length
+    @staticmethod
+    def get_key(outputVideo: OutputVideo) -> str:
+        resolution = ""
+        if outputVideo.inputVideos:
+            resolution = f"{outputVideo.inputVideos[0].origInfo['width']}x{outputVideo.inputVideos[0].origInfo['height']}"
+        return get_hash(f"{SpeedHistory.get_key(outputVideo)}|{resolution}")
+
+    def get_memory(self, outputVideo: OutputVideo) -> int:
+        return self.memory.get(self.get_key(outputVideo), self.DEFAULT_MEMORY)
+
+    def add(self, outputVideo: OutputVideo, peakMemory: int):
+        if peakMemory <= 0:
+            return
+
+        key = self.get_key(outputVideo)
+
+        with self.lock:
+            # keep the highest we've seen, but let it come down slowly if it was a one off
+            self.memory[key] = peakMemory if key not in self.memory else max(peakMemory, int(self.memory[key] * 0.9))
+
+    def save(self):
+        with self.lock:
+            write_cache_file(self.path, "\n".join(f"{key} {memory}" for key, memory in self.memory.items()))
+
+
+class EncodeJob:
+    def __init__(self, order: int, outputVideo: OutputVideo, rawOutput: OutputVideo = None):
+        self.order = order
+        self.outputVideo = outputVideo
+        self.rawOutput = rawOutput
+
+        outputs = [outputVideo] if rawOutput is None else [outputVideo, rawOutput]
+        if outputVideo.ladder is not None:
+            outputs = [rendition for rendition in outputVideo.ladder.renditions if not rendition.skip]
+
+        self.outputs = outputs
+        self.cost = sum(SPEED_HISTORY.get_cost(output) for output in outputs)
+        self.memory = max(MEMORY_HISTORY.get_memory(output) for output in outputs)
+        self.source = outputVideo.inputVideos[0].videoPath if outputVideo.inputVideos else ""
+
+        self.cpus: List[int] = []
+        self.lock = threading.Lock()
+        self.processMemory: Dict[int, int] = {}
+        self.peakMemory = 0
+        self.parallel = 1  # outputs of this job being encoded at once, they share its cpus
+        self.cancelled = threading.Event()
+
+    # kills whatever ffmpeg the job is running, everything after that fails right away
+    def cancel(self):
+        self.cancelled.set()
+
+    # rss of an ffmpeg process in this job, 0 once it's done
+    def update_memory(self, pid: int, rss: int):
+        with self.lock:
+            if rss:
+                self.processMemory[pid] = rss
+            else:
+                self.processMemory.pop(pid, None)
+            self.peakMemory = max(self.peakMemory, sum(self.processMemory.values()))
+
+    def get_memory(self) -> int:
+        with self.lock:
+            return sum(self.processMemory.values())
+
+    @profiled()
+    def run(self):
+        if self.cancelled.is_set():
+            return
+
+        PREFETCHER.job_started(self)
+        slot = CPU_PLANNER.acquire()
+        self.cpus = CPU_PLANNER.get_cpus(slot)
+        JOB_STATE.job = self
+        set_log_job(get_temp_name(self.outputVideo))
+
+        try:
+            if self.outputVideo.ladder is not None:
+                encode_size_ladder(self.outputVideo.ladder)
+                return
+
+            tempFolder = get_temp_folder(self.outputVideo)
+            prepare_temp_folder(tempFolder)
+
+            if self.rawOutput is None:
+                encode_output_video(self.outputVideo, tempFolder)
+                return
+
+            # the raw clips get written while encoding the normal output, so set up its temp folder now
+            rawTempFolder = get_temp_folder(self.rawOutput)
+            prepare_temp_folder(rawTempFolder)
+            companion = RawCompanion(self.rawOutput, rawTempFolder)
+
+            encode_output_video(self.outputVideo, tempFolder, companion)
+            encode_output_video(self.rawOutput, rawTempFolder, companion)
+
+        except Exception:
+            PrintException(f"Failed to encode {self.outputVideo.get_video_path()}")
+            METRIC_JOBS.inc(result="failed")
+
+        finally:
+            JOB_STATE.job = None
+            set_log_job("")
+            CPU_PLANNER.release(slot)
+            DASHBOARD.job_done(self)
+            PREFETCHER.job_finished(self)
+
+            for output in self.outputs:
+                MEMORY_HISTORY.add(output, self.peakMemory)
+                # normally released once the output is encoded, but not if something threw before that
+                SCRATCH.release(get_temp_name(output))
+
+
+# holds back jobs while the machine is busy with something else, or is low on memory or disk space
+class AdmissionControl:
+    def __init__(self):
+        self.maxLoad = ARGS.max_load * len(CPUS)
+        self.minFreeMemory = ARGS.min_free_memory * BYTES_PER_MB
+        self.minFreeDisk = ARGS.min_free_disk * BYTES_PER_MB
+
+    # returns why the job can't start yet, or an empty string if it can
+    def check(self, job: EncodeJob, running: List[EncodeJob]) -> str:
+        if self.maxLoad:
+            # the load average lags behind, so don't let it forget about the jobs we just started
+            threads = sum(CPU_PLANNER.get_threads(runningJob.cpus or CPUS) for runningJob in running)
+            load = max(psutil.getloadavg()[0], threads) + CPU_PLANNER.get_threads(CPU_PLANNER.slices[0])
+            if load > self.maxLoad:
+                return f"load would be {load:.1f}, max is {self.maxLoad:.1f}"
+
+        # running jobs that haven't hit their peak memory yet probably will
+        reserved = sum(max(0, runningJob.memory - runningJob.get_memory()) for runningJob in running)
+        memoryLeft = psutil.virtual_memory().available - reserved - job.memory
+        if memoryLeft < self.minFreeMemory:
+            return f"only {memoryLeft / BYTES_PER_MB:.0f} MB of memory would be left"
+
+        diskLeft = SCRATCH.get_most_free_space() - sum(estimate_temp_size(output) for output in job.outputs)
+        if diskLeft < self.minFreeDisk:
+            return f"only {diskLeft / BYTES_PER_MB:.0f} MB of scratch space would be left"
+
+        return ""
+
+
+# reads the parts of the inputs that upcoming jobs need into the os file cache while the current ones encode,
+# so ffmpeg doesn't sit there waiting on a slow network drive every time it seeks into a new input
+class SourcePrefetcher:
+    BLOCK_SIZE = 8 * BYTES_PER_MB
+
+    def __init__(self):
+        self.budget = ARGS.prefetch * BYTES_PER_MB
+        self.jobs: List[EncodeJob] = []
+        self.started = set()
+        self.prefetched: Dict[int, int] = {}  # bytes read ahead for each job that hasn't finished yet
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def start(self, jobs: List[EncodeJob]):
+        if not self.budget or len(jobs) < 2:
+            return
+
+        with self.condition:
+            self.jobs = jobs
+            self.started = set()
+            self.stopped = False
+
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def job_started(self, job: EncodeJob):
+        with self.condition:
+            self.started.add(id(job))
+            self.condition.notify_all()
+
+    # it's been read by ffmpeg by now, so stop counting it against the budget
+    def job_finished(self, job: EncodeJob):
+        with self.condition:
+            self.prefetched.pop(id(job), None)
+            self.condition.notify_all()
+
+    def is_skipped(self, job: EncodeJob) -> bool:
+        return self.stopped or id(job) in self.started
+
+    # byte position of the first packet at or before this time, -1 if ffprobe couldn't tell us
+    @staticmethod
+    def get_packet_pos(videoPath: str, seconds: float) -> int:
+        ffprobe_command = f"ffprobe -v error -select_streams v:0 -read_intervals {seconds}%+#1 " \
+                          f"-show_entries packet=pos -of csv=p=0 \"{videoPath}\""
+
+        try:
+            output = subprocess.check_output(ffprobe_command, shell=True, universal_newlines=True)
+        except subprocess.CalledProcessError:
+            return -1
+
+        for line in output.splitlines():
+            if line.strip().isdigit():
+                return int(line)
+
+        return -1
+
+    def get_byte_ranges(self, job: EncodeJob) -> List[Tuple[str, int, int]]:
+        byteRanges = []
+        found = set()
+
+        for output in job.outputs:
+            for inputVideo in output.inputVideos:
+                fileSize = os.path.getsize(inputVideo.videoPath)
+                duration = inputVideo.origInfo["duration"].total_seconds() if inputVideo.origInfo["duration"] else 0
+                if duration <= 0:
+                    continue
+
+                for timeRange in inputVideo.timeRanges:
+                    key = (inputVideo.videoPath, timeRange[0], timeRange[1])
+                    if key in found:
+                        continue
+                    found.add(key)
+
+                    # pretend the bitrate is constant if ffprobe can't find the packets, with some slack for that
+                    slack = fileSize // 50
+                    start = self.get_packet_pos(inputVideo.videoPath, timeRange[0].total_seconds())
+                    if start < 0:
+                        start = int(fileSize * timeRange[0].total_seconds() / duration) - slack
+
+                    end = self.get_packet_pos(inputVideo.videoPath, timeRange[1].total_seconds())
+                    end = int(fileSize * timeRange[1].total_seconds() / duration) + slack if end < 0 else end + slack
+
+                    start = max(0, start)
+                    end = min(fileSize, end)
+                    if end > start:
+                        byteRanges.append((inputVideo.videoPath, start, end))
+
+        return byteRanges
+
+    def read_range(self, job: EncodeJob, videoPath: str, start: int, end: int):
+        with open(videoPath, mode="rb", buffering=0) as file:
+            if hasattr(os, "posix_fadvise"):
+                # gets the kernel reading ahead on its own while we go through it
+                os.posix_fadvise(file.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+
+            file.seek(start)
+            buffer = bytearray(self.BLOCK_SIZE)
+            position = start
+
+            while position < end and not self.is_skipped(job):
+                read = file.readinto(buffer)
+                if not read:
+                    break
+                position += read
+
+    def run(self):
+        # the first job is already reading its own input
+        for job in self.jobs[1:]:
+            if self.is_skipped(job):
+                continue
+
+            try:
+                byteRanges = self.get_byte_ranges(job)
+            except OSError as F:
+                print(f"Failed to prefetch {job.outputVideo.get_video_path()} - {F}")
+                continue
+
+            # anything bigger than the whole budget only gets the start of it read ahead
+            size = min(sum(end - start for _, start, end in byteRanges), self.budget)
+
+            with self.condition:
+                self.condition.wait_for(lambda: self.is_skipped(job) or
+                                        sum(self.prefetched.values()) + size <= self.budget)
+                if self.is_skipped(job):
+                    continue
+                self.prefetched[id(job)] = size
+
+            try:
+                for videoPath, start, end in byteRanges:
+                    if size <= 0 or self.is_skipped(job):
+                        break
+                    end = min(end, start + size)
+                    self.read_range(job, videoPath, start, end)
+                    size -= end - start
+
+            except OSError as F:
+                print(f"Failed to prefetch {job.outputVideo.get_video_path()} - {F}")
+
+
+def run_jobs(jobs: List[EncodeJob]):
+    admission = AdmissionControl()
+    running: Dict[EncodeJob, threading.Thread] = {}
+
+    # jobs start in the order they're in
+    for job in jobs:
+        held = False
+
+        while True:
+            running = {runningJob: thread for runningJob, thread in running.items() if thread.is_alive()}
+
+            if len(running) < ARGS.jobs:
+                # always let a job through if nothing is running, or nothing would ever finish
+                reason = admission.check(job, list(running)) if running else ""
+                if not reason:
+                    break
+
+                if not held:
+                    print(f"\nHolding {job.outputVideo.get_video_path()}: {reason}")
+                    held = True
+
+            time.sleep(1)
+
+        thread = threading.Thread(target=job.run)
+        thread.start()
+        running[job] = thread
+
+    for thread in running.values():
+        thread.join()
+
+
+def order_jobs(jobs: List[EncodeJob], policy: str) -> List[EncodeJob]:
+    if policy == "longest":
+        return sorted(jobs, key=lambda job: (-job.cost, job.order))
+
+    # keep jobs reading the same input together, so it's still in the disk cache
+    groups: Dict[str, List[EncodeJob]] = {}
+    for job in jobs:
+        groups.setdefault(job.source, []).append(job)
+
+    if policy == "source":
+        return [job for group in groups.values() for job in group]
+
+    if policy == "balanced":
+        groupList = sorted(groups.values(), key=lambda group: -sum(job.cost for job in group))
+        return [job for group in groupList for job in sorted(group, key=lambda job: (-job.cost, job.order))]
+
+    return jobs
+
+
+def run_encoding(watch=None):
+    videoList = VIDEO_CONFIG.videoList
+    rawOutputs: Dict[str, OutputVideo] = {}
+
+    if VIDEO_CONFIG_RAW:
+        videoList = videoList + VIDEO_CONFIG_RAW.videoList
+
+        # raw outputs that get encoded alongside their normal output
+        normalOutputs = {outputVideo.videoPath for outputVideo in VIDEO_CONFIG.videoList
+                         if not outputVideo.skip and outputVideo.ladder is None}
+        rawOutputs = {outputVideo.videoPath: outputVideo for outputVideo in VIDEO_CONFIG_RAW.videoList
+                      if not outputVideo.skip and outputVideo.videoPath in normalOutputs}
+
+    # only what changed since the last pass, a raw output only rides along if its normal output changed too
+    if watch is not None:
+        videoList = [outputVideo for outputVideo in videoList if watch.should_encode(outputVideo)]
+        queuedPaths = {outputVideo.videoPath for outputVideo in videoList if not outputVideo.raw}
+        rawOutputs = {videoPath: rawOutput for videoPath, rawOutput in rawOutputs.items()
+                      if videoPath in queuedPaths and watch.should_encode(rawOutput)}
+    
+    print_timestamps(videoList)
+    SEGMENT_PLANNER.plan(videoList)
+
+    jobs: List[EncodeJob] = []
+    queuedLadders = set()
+    
+    for outputVideo in videoList:
+        if outputVideo.skip or not ARGS.encode:
+            move_video_check(outputVideo)
             continue
 
-        # write_hash_file(os.path.basename(outputVideo.get_video_name()), outputVideo.hashList)
-        write_hash_file(get_hash(outputVideo.get_video_path()), outputVideo.hashList)
-        
-        # move inputs to "move" folder
-        move_video_check(outputVideo)
+        # already encoded alongside its normal output
+        if outputVideo.raw and outputVideo.videoPath in rawOutputs:
+            continue
+
+        if outputVideo.ladder is not None:
+            if id(outputVideo.ladder) not in queuedLadders:
+                queuedLadders.add(id(outputVideo.ladder))
+                jobs.append(EncodeJob(len(jobs), outputVideo))
+            continue
+
+        rawOutput = None if outputVideo.raw else rawOutputs.get(outputVideo.videoPath)
+        jobs.append(EncodeJob(len(jobs), outputVideo, rawOutput))
+
+    jobs = order_jobs(jobs, ARGS.order)
+    if watch is not None:
+        watch.track(jobs)
+
+    PREFETCHER.start(jobs)
+    DASHBOARD.start(jobs)
+
+    if ARGS.jobs <= 1:
+        for job in jobs:
+            job.run()
+    else:
+        run_jobs(jobs)
+
+    PREFETCHER.stop()
+
+    # broken outputs get redone from scratch
+    for attempt in range(ARGS.verify_retries):
+        for outputVideo in VERIFIER.wait():
+            print_color(Color.YELLOW, f"\nRetrying Output Video: {outputVideo.get_video_path()}")
+            SEGMENT_PLANNER.invalidate_output(outputVideo)
+            tempFolder = get_temp_folder(outputVideo)
+            prepare_temp_folder(tempFolder)
+            encode_output_video(outputVideo, tempFolder)
+
+    for outputVideo in VERIFIER.wait():
+        warning(f"Giving up on Output Video: {outputVideo.get_video_path()}")
+
+    DASHBOARD.stop()
+
+    SPEED_HISTORY.save()
+    MEMORY_HISTORY.save()
+
+    if not ARGS.keep_temp:
+        shutil.rmtree(f"{SCRATCH.get_main_root()}audio", ignore_errors=True)
         
     print("\nFinished!")
     
     
+@profiled()
 def move_video(outputVideo: OutputVideo, inputVideo: VideoFile):
     print("\nMoving Input: " + inputVideo.videoPath)
     postFix = os.path.commonprefix([outputVideo.videoDir, inputVideo.videoDir])
@@ -1639,6 +3718,209 @@ def move_video(outputVideo: OutputVideo, inputVideo: VideoFile):
     shutil.move(inputVideo.videoPath, VIDEO_CONFIG.moveFolder + "/" + inputVideo.videoName)
 
 
+# ==================================================================================================
+# Watch Mode
+# ==================================================================================================
+
+
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_MOVED_TO = 0x80
+IN_CLOSE_WRITE = 0x08
+
+
+# waits for config files to change, with inotify on linux so it wakes up right away, and by checking
+# the date modified and size every second everywhere else. editors tend to save by writing a new file and
+# renaming it over the old one, so the folders are watched instead of the files
+class ConfigWatcher:
+    POLL_INTERVAL = 1.0
+    SETTLE_TIME = 0.3  # some editors write a file in more than one go
+
+    def __init__(self):
+        self.files: Dict[str, Tuple[float, int]] = {}
+        self.folders = set()
+        self.inotify = -1
+        self.libc = None
+
+        if sys.platform.startswith("linux"):
+            try:
+                self.libc = ctypes.CDLL(None, use_errno=True)
+                self.inotify = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            except (OSError, AttributeError):
+                self.inotify = -1
+
+        if self.inotify < 0:
+            print("inotify not available, checking the config for changes every second")
+
+    def set_files(self, paths: List[str]):
+        self.files = {path: get_file_signature(path) for path in paths}
+
+        if self.inotify < 0:
+            return
+
+        for folder in {os.path.dirname(path) for path in paths} - self.folders:
+            mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            if self.libc.inotify_add_watch(self.inotify, os.fsencode(folder), mask) < 0:
+                print(f"failed to watch {folder}: {os.strerror(ctypes.get_errno())}")
+            else:
+                self.folders.add(folder)
+
+    def get_changed(self) -> List[str]:
+        return [path for path, signature in self.files.items() if get_file_signature(path) != signature]
+
+    # returns the files that changed, or nothing if none did before the timeout
+    def wait(self, timeout: float) -> List[str]:
+        if self.inotify >= 0:
+            # anything in the folder wakes us up, the signatures say if it was one of ours
+            readable, _, _ = select.select([self.inotify], [], [], timeout)
+            if readable:
+                self.drain()
+        else:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+
+        changed = self.get_changed()
+        if not changed:
+            return []
+
+        # wait for it to stop changing, so we don't parse half a file
+        while True:
+            signatures = {path: get_file_signature(path) for path in self.files}
+            time.sleep(self.SETTLE_TIME)
+            self.drain()
+            if signatures == {path: get_file_signature(path) for path in self.files}:
+                break
+
+        return self.get_changed()
+
+    def drain(self):
+        if self.inotify < 0:
+            return
+        try:
+            while os.read(self.inotify, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        if self.inotify >= 0:
+            os.close(self.inotify)
+            self.inotify = -1
+
+
+def get_output_key(outputVideo: OutputVideo) -> str:
+    return ("raw|" if outputVideo.raw else "") + outputVideo.get_video_path()
+
+
+# keeps running after the first pass, and whenever the config changes, encodes only the outputs whose block changed.
+# jobs for outputs that changed again or got removed while encoding are cancelled. the lexed config files,
+# probe output and hash files stay in memory between passes, so a reload only reads what changed
+class WatchSession:
+    def __init__(self):
+        self.watcher = ConfigWatcher()
+        self.definitions: Dict[str, Tuple[str, ...]] = {}  # output key -> everything its config block set
+        self.queued = None  # output keys the current pass encodes, None for everything
+        self.pending = set()  # changed while the current pass was running
+        self.nextConfigs = None
+        self.jobs: List[EncodeJob] = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_definitions(*configs: VideoConfig) -> Dict[str, Tuple[str, ...]]:
+        definitions = {}
+        for config in configs:
+            if config is None:
+                continue
+            for outputVideo in config.videoList:
+                definitions[get_output_key(outputVideo)] = outputVideo.get_definition()
+        return definitions
+
+    def should_encode(self, outputVideo: OutputVideo) -> bool:
+        return self.queued is None or get_output_key(outputVideo) in self.queued
+
+    def track(self, jobs: List[EncodeJob]):
+        with self.lock:
+            self.jobs = jobs
+
+    def cancel_jobs(self, keys: set):
+        with self.lock:
+            for job in self.jobs:
+                if job.cancelled.is_set():
+                    continue
+                if any(get_output_key(output) in keys for output in job.outputs):
+                    print_color(Color.YELLOW, f"\nCancelling {job.outputVideo.get_video_path()}, its config changed")
+                    job.cancel()
+
+    @profiled()
+    def reload(self, changedFiles: List[str]):
+        print_color(Color.CYAN, "\nConfig Changed: " + ", ".join(changedFiles))
+
+        # nothing gets moved in watch mode, this only has to match what the new config uses
+        ALL_INPUT_VIDEOS.clear()
+
+        config = VideoConfig(VIDEO_CONFIG.raw)
+        config.load(ARGS.input)
+        rawConfig = None
+        if VIDEO_CONFIG_RAW:
+            rawConfig = VideoConfig(True)
+            rawConfig.load(ARGS.input)
+
+        definitions = self.get_definitions(config, rawConfig)
+        changed = {key for key, definition in definitions.items() if self.definitions.get(key) != definition}
+        removed = set(self.definitions) - set(definitions)
+
+        self.definitions = definitions
+        self.cancel_jobs(changed | removed)
+        self.pending |= changed
+        self.nextConfigs = (config, rawConfig)
+        self.watcher.set_files(config.configFiles)
+
+        print_color(Color.CYAN, f"{len(changed)} output(s) changed, {len(removed)} removed")
+
+    def swap_configs(self):
+        global VIDEO_CONFIG, VIDEO_CONFIG_RAW
+
+        if self.nextConfigs is not None:
+            VIDEO_CONFIG, VIDEO_CONFIG_RAW = self.nextConfigs
+            self.nextConfigs = None
+
+        self.queued = self.pending
+        self.pending = set()
+
+    def run(self):
+        self.definitions = self.get_definitions(VIDEO_CONFIG, VIDEO_CONFIG_RAW)
+        self.watcher.set_files(VIDEO_CONFIG.configFiles)
+
+        try:
+            while True:
+                encoding = threading.Thread(target=run_encoding, args=(self,))
+                encoding.start()
+
+                # keep reloading while it encodes, cancelling anything that changed
+                idle = False
+                while encoding.is_alive() or not self.pending:
+                    if not encoding.is_alive() and not idle:
+                        print_color(Color.CYAN, f"\nWatching {len(self.watcher.files)} config file(s) for changes, "
+                                                f"Ctrl+C to stop")
+                        idle = True
+
+                    changedFiles = self.watcher.wait(1.0)
+                    if changedFiles:
+                        self.reload(changedFiles)
+
+                encoding.join()
+                self.swap_configs()
+
+        except KeyboardInterrupt:
+            print_color(Color.YELLOW, "\nStopping, cancelling running jobs")
+            with self.lock:
+                for job in self.jobs:
+                    job.cancel()
+            encoding.join()
+
+        finally:
+            self.watcher.close()
+
+
 # ==================================================================================================
 # Other 2
 # ==================================================================================================
@@ -1646,8 +3928,49 @@ def move_video(outputVideo: OutputVideo, inputVideo: VideoFile):
 
 if __name__ == "__main__":
     ARGS = parse_args()
-    VIDEO_CONFIG = VideoConfig()
+    PROFILER.enabled = bool(ARGS.profile)
+    setup_logging(Level.DEBUG if ARGS.verbose else Level.INFO, ARGS.log_dir or "", ARGS.log_json or "",
+                  ARGS.log_timestamps)
+    if ARGS.watch and (ARGS.move_files or not ARGS.encode):
+        error("--watch only works with -e, and without -m")
+    VIDEO_CONFIG = VideoConfig(ARGS.encode_raw and not ARGS.encode_both)
+    VIDEO_CONFIG_RAW = VideoConfig(True) if ARGS.encode_both else None
+    SCRATCH = ScratchManager(ARGS.temp_dir or [TEMP_FOLDER], ARGS.min_free_disk * BYTES_PER_MB)
+    SEGMENT_PLANNER = SegmentPlanner()
+    SCENE_INDEXER = SceneIndexer()
+    SPEED_HISTORY = SpeedHistory()
+    MEMORY_HISTORY = MemoryHistory()
+    PREFETCHER = SourcePrefetcher()
+    VERIFIER = OutputVerifier()
+    DASHBOARD = Dashboard()
+    METRICS.add_collector(collect_metrics)
+    METRICS.start(ARGS.metrics or "", ARGS.metrics_port)
     VIDEO_CONFIG.load(ARGS.input)
+
+    if VIDEO_CONFIG_RAW:
+        VIDEO_CONFIG_RAW.load(ARGS.input)
     
-    CPUS = list(range(*[int(cpu) for cpu in ARGS.cpus]))
-    run_encoding()
+    # index the rest of the inputs while encoding
+    SCENE_INDEXER.queue_all(list(dict.fromkeys(ALL_INPUT_VIDEOS)))
+
+    CPUS = get_usable_cpus()
+    if ARGS.cpus:
+        CPUS = [cpu for cpu in range(*[int(cpu) for cpu in ARGS.cpus]) if cpu in CPUS] or CPUS
+
+    CPU_PLANNER = CpuPlanner(CPUS, ARGS.jobs)
+    PROCESS_LIMITS = get_process_limits()
+
+    if ARGS.watch:
+        WatchSession().run()
+    else:
+        run_encoding()
+    SCENE_INDEXER.shutdown()
+    VERIFIER.shutdown()
+    METRICS.stop()
+
+    if ARGS.profile:
+        PROFILER.write_trace(ARGS.profile)
+        PROFILER.print_summary()
+        print(f"\nWrote Trace: {ARGS.profile}")
+
+    shutdown_logging()
@@ -0,0 +1,224 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Tuple, Callable
+
+
+# label name/value pairs, sorted so the same labels always end up as the same key
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def get_label_key(labels: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key: LabelKey, extra: str = "") -> str:
+    parts = [f'{name}="{escape_label(value)}"' for name, value in key]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, helpText: str):
+        self.name = name
+        self.helpText = helpText
+        self.lock = threading.Lock()
+        self.values: Dict[LabelKey, float] = {}
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(get_label_key(labels), 0)
+
+    # summed over every label
+    def get_total(self) -> float:
+        with self.lock:
+            return sum(self.values.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.helpText}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(key)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = get_label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[get_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, helpText: str, buckets: List[float]):
+        super().__init__(name, helpText)
+        self.buckets = sorted(buckets) + [float("inf")]
+        self.counts: Dict[LabelKey, List[int]] = {}
+        self.sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = get_label_key(labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * len(self.buckets))
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    counts[index] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.helpText}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, counts in self.counts.items():
+                for bucket, count in zip(self.buckets, counts):
+                    bucketLabel = 'le="' + format_value(bucket) + '"'
+                    lines.append(f"{self.name}_bucket{format_labels(key, bucketLabel)} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {format_value(self.sums[key])}")
+                lines.append(f"{self.name}_count{format_labels(key)} {counts[-1]}")
+        return lines
+
+
+# counters and histograms in the prometheus text format, written to a file for node_exporter's textfile collector
+# and/or served on localhost. counting always happens, it's only exported once started
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.metrics: List[Metric] = []
+        self.collectors: List[Callable[[], None]] = []
+        self.path = ""
+        self.interval = 15.0
+        self.server = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def counter(self, name: str, helpText: str) -> Counter:
+        return self.add(Counter(name, helpText))
+
+    def gauge(self, name: str, helpText: str) -> Gauge:
+        return self.add(Gauge(name, helpText))
+
+    def histogram(self, name: str, helpText: str, buckets: List[float]) -> Histogram:
+        return self.add(Histogram(name, helpText, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    # called right before rendering, for gauges that are cheaper to read when asked for than to keep updated
+    def add_collector(self, func: Callable[[], None]):
+        self.collectors.append(func)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as F:
+                print(f"metrics collector failed: {F}")
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    # the collector can read the file at any time, so it's swapped in whole
+    def write_textfile(self):
+        if not self.path:
+            return
+
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+
+        with open(self.path + ".tmp", mode="w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(self.path + ".tmp", self.path)
+
+    def start(self, path: str = "", port: int = 0, interval: float = 15.0):
+        if not path and not port:
+            return
+
+        self.enabled = True
+        self.path = path
+        self.interval = interval
+
+        if port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), _make_handler(self))
+            self.server.daemon_threads = True
+            serverThread = threading.Thread(target=self.server.serve_forever)
+            serverThread.daemon = True
+            serverThread.start()
+            print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+
+        if path:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_textfile()
+            except OSError as F:
+                print(f"failed to write metrics: {F}")
+
+    def stop(self):
+        if not self.enabled:
+            return
+
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+        # so the last scrape has the final numbers
+        self.write_textfile()
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def _make_handler(metrics: Metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # every scrape would end up in the log otherwise
+        def log_message(self, *args):
+            pass
+
+    return MetricsHandler
+
+
+METRICS = Metrics()
@@ -0,0 +1,127 @@
+import os
+import json
+import time
+import threading
+import functools
+from typing import List, Dict
+
+
+class Span:
+    def __init__(self, name: str):
+        self.name = name
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = 0.0
+        self.args: Dict[str, object] = {}
+
+    def get_duration(self) -> float:
+        return self.end - self.start
+
+
+# timing spans for --profile, does nothing until enabled
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.startTime = time.perf_counter()
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self) -> List[Span]:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def begin(self, name: str) -> Span:
+        stack = self.get_stack()
+        span = Span(name)
+        stack.append(span)
+        return span
+
+    def finish(self, span: Span):
+        span.end = time.perf_counter()
+
+        stack = self.get_stack()
+        if span in stack:
+            stack.remove(span)
+
+        with self.lock:
+            self.spans.append(span)
+
+    # adds info to the innermost span running on this thread, like how much cpu time ffmpeg used
+    def set_arg(self, key: str, value):
+        stack = self.get_stack()
+        if self.enabled and stack:
+            stack[-1].args[key] = value
+
+    def span(self, name: str):
+        return _SpanContext(self, name)
+
+    # chrome://tracing and ui.perfetto.dev can both open this
+    def write_trace(self, path: str):
+        events = []
+        with self.lock:
+            for span in self.spans:
+                events.append({
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self.startTime) * 1000000,
+                    "dur": span.get_duration() * 1000000,
+                    "pid": os.getpid(),
+                    "tid": span.thread,
+                    "args": span.args,
+                })
+
+        with open(path, mode="w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+    def print_summary(self, count: int = 15):
+        stages: Dict[str, List[float]] = {}  # name -> [calls, total, max, child cpu]
+
+        with self.lock:
+            for span in self.spans:
+                stage = stages.setdefault(span.name, [0, 0.0, 0.0, 0.0])
+                stage[0] += 1
+                stage[1] += span.get_duration()
+                stage[2] = max(stage[2], span.get_duration())
+                stage[3] += span.args.get("child_cpu", 0.0)
+
+        print(f"\n{'Stage':<32} {'Calls':>7} {'Total':>10} {'Average':>10} {'Max':>10} {'Child CPU':>10}")
+        for name, (calls, total, longest, cpu) in sorted(stages.items(), key=lambda item: -item[1][1])[:count]:
+            print(f"{name:<32} {calls:>7} {total:>9.2f}s {total / calls:>9.3f}s {longest:>9.2f}s {cpu:>9.2f}s")
+
+
+class _SpanContext:
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+        self.span = None
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.span = self.profiler.begin(self.name)
+        return self.span
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            self.profiler.finish(self.span)
+        return False
+
+
+PROFILER = Profiler()
+
+
+def profiled(name: str = ""):
+    def decorator(func):
+        spanName = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            with PROFILER.span(spanName):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
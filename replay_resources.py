@@ -0,0 +1,378 @@
+import os
+import math
+import shlex
+import shutil
+import threading
+import subprocess
+from typing import List, Dict, Tuple
+
+import psutil
+
+
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_BELOW_NORMAL = "below_normal"
+PRIORITY_IDLE = "idle"
+
+# nice values used on linux and mac for each priority
+POSIX_NICE = {
+    PRIORITY_HIGH: -5,
+    PRIORITY_NORMAL: 0,
+    PRIORITY_BELOW_NORMAL: 10,
+    PRIORITY_IDLE: 19,
+}
+
+IO_CLASSES = ["best-effort", "idle"]
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+class ProcessLimits:
+    def __init__(self):
+        self.priority = PRIORITY_NORMAL
+        self.nice = None  # overrides the nice value from the priority on posix
+        self.ioClass = ""  # linux only, "best-effort" or "idle"
+        self.cpus: List[int] = []
+
+        # cgroup v2, only used if we're allowed to make cgroups
+        self.cpuLimit = 0.0  # percent of one cpu, 400 is 4 cpus worth
+        self.memoryLimit = 0  # in bytes
+
+    def copy(self):
+        limits = ProcessLimits()
+        limits.__dict__.update(self.__dict__)
+        limits.cpus = self.cpus.copy()
+        return limits
+
+
+# windows takes the command line as is, everything else needs it split into args since we don't use the shell
+def split_cmd(cmd: str):
+    if os.name == "nt":
+        return cmd
+    return shlex.split(cmd)
+
+
+def get_creation_flags(limits: ProcessLimits) -> int:
+    if os.name != "nt":
+        return 0
+
+    if limits.priority == PRIORITY_HIGH:
+        return subprocess.HIGH_PRIORITY_CLASS
+    elif limits.priority == PRIORITY_BELOW_NORMAL:
+        return subprocess.BELOW_NORMAL_PRIORITY_CLASS
+    elif limits.priority == PRIORITY_IDLE:
+        return subprocess.IDLE_PRIORITY_CLASS
+
+    return subprocess.NORMAL_PRIORITY_CLASS
+
+
+# returns the cgroup made for this process if there is one, pass it to remove_cgroup once the process is done
+def apply_process_limits(pid: int, limits: ProcessLimits) -> str:
+    process = psutil.Process(pid)
+
+    if limits.cpus:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(pid, limits.cpus)
+        elif hasattr(process, "cpu_affinity"):
+            process.cpu_affinity(limits.cpus)
+
+    # priority is already set through the creation flags on windows
+    if os.name != "nt":
+        nice = limits.nice if limits.nice is not None else POSIX_NICE[limits.priority]
+        if nice != 0:
+            try:
+                process.nice(nice)
+            except psutil.AccessDenied:
+                # need root to go below 0
+                print(f"not allowed to set nice value {nice}, leaving it at {process.nice()}")
+
+    if limits.ioClass and hasattr(process, "ionice") and hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+        if limits.ioClass == "idle":
+            process.ionice(psutil.IOPRIO_CLASS_IDLE)
+        else:
+            # lowest priority within best effort
+            process.ionice(psutil.IOPRIO_CLASS_BE, 7)
+
+    if limits.cpuLimit or limits.memoryLimit:
+        return create_cgroup(pid, limits)
+
+    return ""
+
+
+def get_cgroup_path() -> str:
+    if not os.path.isfile(f"{CGROUP_ROOT}/cgroup.controllers") or not os.path.isfile("/proc/self/cgroup"):
+        return ""
+
+    with open("/proc/self/cgroup", mode="r", encoding="utf-8") as file:
+        for line in file.read().splitlines():
+            # cgroup v2 is the one with an empty hierarchy id and controller list
+            if line.startswith("0::"):
+                return os.path.normpath(CGROUP_ROOT + line[3:])
+
+    return ""
+
+
+# how many cpus worth of time our cgroup is allowed to use, 0 if there's no limit
+def get_cgroup_cpu_quota() -> float:
+    cgroupPath = get_cgroup_path()
+    if not cgroupPath:
+        return 0
+
+    quota = 0
+    # the limit can be set on any parent, the lowest one wins
+    while cgroupPath.startswith(CGROUP_ROOT) and cgroupPath != CGROUP_ROOT:
+        cpuMax = os.path.join(cgroupPath, "cpu.max")
+        if os.path.isfile(cpuMax):
+            with open(cpuMax, mode="r", encoding="utf-8") as file:
+                maxTime, _, period = file.read().strip().partition(" ")
+            if maxTime != "max" and period:
+                cpus = int(maxTime) / int(period)
+                quota = cpus if not quota else min(quota, cpus)
+        cgroupPath = os.path.dirname(cgroupPath)
+
+    return quota
+
+
+# the cpus we're allowed to run on
+def get_usable_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    try:
+        return sorted(psutil.Process().cpu_affinity())
+    except (AttributeError, psutil.Error):
+        return list(range(os.cpu_count() or 1))
+
+
+# groups hyperthreads on the same physical core together
+def get_cpu_cores(cpus: List[int]) -> List[List[int]]:
+    cores: List[List[int]] = []
+    found = set()
+
+    for cpu in cpus:
+        if cpu in found:
+            continue
+
+        siblings = [cpu]
+        siblingsFile = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        if os.path.isfile(siblingsFile):
+            with open(siblingsFile, mode="r", encoding="utf-8") as file:
+                siblings = [sibling for sibling in parse_cpu_list(file.read()) if sibling in cpus]
+
+        found.update(siblings)
+        cores.append(siblings)
+
+    return cores
+
+
+# "0-3,8-11" -> [0, 1, 2, 3, 8, 9, 10, 11]
+def parse_cpu_list(text: str) -> List[int]:
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+# splits the cpus into one slice per job, keeping hyperthreads of the same core in the same slice
+class CpuPlanner:
+    def __init__(self, cpus: List[int], jobs: int):
+        self.cpus = cpus
+        self.quota = get_cgroup_cpu_quota()
+        self.lock = threading.Lock()
+
+        cores = get_cpu_cores(cpus)
+        jobs = max(1, jobs)
+        sliceCount = max(1, min(jobs, len(cores)))
+
+        slices: List[List[int]] = [[] for _ in range(sliceCount)]
+        for index, core in enumerate(cores):
+            slices[index * sliceCount // len(cores)].extend(core)
+
+        # more jobs than cores, so some of them have to share
+        self.slices = [slices[index % sliceCount] for index in range(jobs)]
+        self.free = list(range(jobs))
+
+    def acquire(self) -> int:
+        with self.lock:
+            return self.free.pop(0) if self.free else -1
+
+    def release(self, slot: int):
+        if slot < 0:
+            return
+        with self.lock:
+            self.free.append(slot)
+
+    def get_cpus(self, slot: int) -> List[int]:
+        return self.slices[slot] if slot >= 0 else self.cpus
+
+    # encoder threads for one slice, going over the cgroup quota just makes them fight over the time we have
+    def get_threads(self, cpus: List[int]) -> int:
+        threads = len(cpus)
+        if self.quota:
+            threads = min(threads, math.ceil(self.quota / len(self.slices)))
+        return max(1, threads)
+
+
+# picks which scratch folder temp files go in, keeping track of how much space each job is expected to use,
+# so a job falls back to the next folder instead of filling up the first one halfway through
+class ScratchManager:
+    def __init__(self, roots: List[str], minFree: int):
+        self.roots = [os.path.join(os.path.abspath(root), "") for root in roots]
+        self.minFree = minFree
+        self.reservations: Dict[str, Tuple[str, int]] = {}  # key -> root and size, the key is also the folder name
+        self.lock = threading.Lock()
+
+        for root in self.roots:
+            os.makedirs(root, exist_ok=True)
+
+    # for stuff shared between jobs
+    def get_main_root(self) -> str:
+        return self.roots[0]
+
+    @staticmethod
+    def get_written(folder: str) -> int:
+        written = 0
+        for dirPath, _, fileNames in os.walk(folder):
+            for fileName in fileNames:
+                try:
+                    written += os.lstat(os.path.join(dirPath, fileName)).st_size
+                except OSError:
+                    pass  # deleted while we were looking
+        return written
+
+    # what the running jobs are still expected to write, what they already wrote is gone from the free space
+    def get_reserved(self, root: str) -> int:
+        return sum(max(0, size - self.get_written(root + key))
+                   for key, (keyRoot, size) in self.reservations.items() if keyRoot == root)
+
+    def get_free_space(self, root: str) -> int:
+        return shutil.disk_usage(root).free - self.get_reserved(root)
+
+    def get_most_free_space(self) -> int:
+        with self.lock:
+            return max(self.get_free_space(root) for root in self.roots)
+
+    # returns the scratch folder to use, reserving the space under the key until it's released
+    def reserve(self, key: str, size: int) -> str:
+        with self.lock:
+            if key in self.reservations:
+                return self.reservations[key][0]
+
+            root = next((root for root in self.roots if self.get_free_space(root) - size >= self.minFree), None)
+            if root is None:
+                # nothing has room, so use whatever has the most and hope the size was overestimated
+                root = max(self.roots, key=self.get_free_space)
+                print(f"no scratch folder has {size / 1048576:.0f} MB free, using {root}")
+
+            self.reservations[key] = (root, size)
+            return root
+
+    def release(self, key: str):
+        with self.lock:
+            self.reservations.pop(key, None)
+
+
+# the cgroup the ffmpeg cgroups go under, set up on first use. empty and not tried again once it fails
+_cgroupParent = ""
+_cgroupFailed = False
+_cgroupLock = threading.Lock()
+
+
+def get_cgroup_controllers(limits: ProcessLimits) -> List[str]:
+    controllers = []
+    if limits.cpuLimit:
+        controllers.append("cpu")
+    if limits.memoryLimit:
+        controllers.append("memory")
+    return controllers
+
+
+# controllers can only be handed down from a cgroup with no processes in it,
+# so we move into a leaf of our own first, and then enable them for the ffmpeg cgroups next to it
+def setup_cgroup_parent(limits: ProcessLimits) -> str:
+    global _cgroupParent, _cgroupFailed
+
+    with _cgroupLock:
+        if _cgroupParent or _cgroupFailed:
+            return _cgroupParent
+
+        parentPath = get_cgroup_path()
+        if not parentPath:
+            _cgroupFailed = True
+            print("cgroup limits not available: no cgroup v2, not using them")
+            return ""
+
+        controllers = get_cgroup_controllers(limits)
+
+        try:
+            with open(os.path.join(parentPath, "cgroup.controllers"), mode="r", encoding="utf-8") as file:
+                available = file.read().split()
+
+            missing = [controller for controller in controllers if controller not in available]
+            if missing:
+                raise OSError(f"the {' and '.join(missing)} controller isn't delegated to us")
+
+            leafPath = os.path.join(parentPath, "replay_maker")
+            os.makedirs(leafPath, exist_ok=True)
+            with open(os.path.join(leafPath, "cgroup.procs"), mode="w") as file:
+                file.write(str(os.getpid()))
+
+            with open(os.path.join(parentPath, "cgroup.subtree_control"), mode="w") as file:
+                file.write(" ".join(f"+{controller}" for controller in controllers))
+
+        except OSError as F:
+            # usually no permission, or something else is still in our cgroup
+            _cgroupFailed = True
+            print(f"cgroup limits not available: {F}, not using them")
+            return ""
+
+        _cgroupParent = parentPath
+        return _cgroupParent
+
+
+def create_cgroup(pid: int, limits: ProcessLimits) -> str:
+    global _cgroupFailed
+
+    parentPath = setup_cgroup_parent(limits)
+    if not parentPath:
+        return ""
+
+    cgroupPath = os.path.join(parentPath, f"replay_maker_{pid}")
+
+    try:
+        os.makedirs(cgroupPath, exist_ok=True)
+
+        if limits.cpuLimit:
+            period = 100000
+            with open(os.path.join(cgroupPath, "cpu.max"), mode="w") as file:
+                file.write(f"{int(period * limits.cpuLimit / 100)} {period}")
+
+        if limits.memoryLimit:
+            with open(os.path.join(cgroupPath, "memory.max"), mode="w") as file:
+                file.write(str(int(limits.memoryLimit)))
+
+        with open(os.path.join(cgroupPath, "cgroup.procs"), mode="w") as file:
+            file.write(str(pid))
+
+    except OSError as F:
+        remove_cgroup(cgroupPath)
+        with _cgroupLock:
+            if not _cgroupFailed:
+                _cgroupFailed = True
+                print(f"cgroup limits not available: {F}, not using them")
+        return ""
+
+    return cgroupPath
+
+
+def remove_cgroup(cgroupPath: str):
+    if not cgroupPath:
+        return
+
+    try:
+        os.rmdir(cgroupPath)
+    except OSError:
+        pass
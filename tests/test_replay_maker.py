@@ -0,0 +1,387 @@
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip("psutil")
+pytest.importorskip("PyQt5")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import replay_maker_v2 as rm
+except OSError as F:
+    # python-mpv raises this instead of ImportError when libmpv isn't installed
+    pytest.skip(f"libmpv isn't available: {F}", allow_module_level=True)
+
+
+PROBE_OUTPUT = "\n".join([
+    "codec_type=video",
+    "width=1920",
+    "height=1080",
+    "r_frame_rate=60/1",
+    "codec_type=audio",
+    "duration=0:02:00",
+    "bit_rate=8000000",
+])
+
+
+@pytest.fixture
+def replay(monkeypatch, tmp_path):
+    monkeypatch.setattr(sys, "argv", ["replay_maker_v2.py", "-e", "-j", "2"])
+    monkeypatch.setattr(rm, "ARGS", rm.parse_args(), raising=False)
+    monkeypatch.setattr(rm, "get_probe_output", lambda videoPath: PROBE_OUTPUT)
+    monkeypatch.setattr(rm, "CPUS", list(range(8)), raising=False)
+    monkeypatch.setattr(rm, "CPU_PLANNER", rm.CpuPlanner(list(range(8)), 2), raising=False)
+    monkeypatch.setattr(rm, "SCRATCH", rm.ScratchManager([str(tmp_path)], 0), raising=False)
+    monkeypatch.setattr(rm, "SEGMENT_PLANNER", rm.SegmentPlanner(), raising=False)
+    yield rm
+    rm.JOB_STATE.job = None
+
+
+def make_output(path: str, ranges=(("0:00:10", "0:00:40"),), inputPath: str = "input.mkv",
+                raw: bool = False) -> rm.OutputVideo:
+    outputVideo = rm.OutputVideo(path, raw)
+    outputVideo.videoExt = ".webm"
+    outputVideo.videoExtRaw = ".mkv"
+    outputVideo.targetSize = 8000
+
+    inputVideo = outputVideo.create_input_video(inputPath)
+    for start, end in ranges:
+        inputVideo.add_time_range(start, end)
+
+    return outputVideo
+
+
+def set_job(cpus, parallel: int = 1):
+    rm.JOB_STATE.job = types.SimpleNamespace(cpus=cpus, parallel=parallel)
+
+
+def test_shared_clips_found_inside_jobs(replay):
+    outputs = [make_output("a.webm"), make_output("b.webm")]
+    replay.SEGMENT_PLANNER.plan(outputs)
+
+    # planned outside any job, looked up from a job with half the cpus
+    set_job(replay.CPU_PLANNER.get_cpus(0))
+
+    for outputVideo in outputs:
+        inputVideo = outputVideo.inputVideos[0]
+        bitrate = outputVideo.calc_target_bitrate()[0]
+        _, cmd = replay.gen_encode_cmd(outputVideo, inputVideo, 0, "", inputVideo.timeRanges[0], 0, bitrate)
+        assert replay.SEGMENT_PLANNER.get_shared(cmd, outputVideo.videoExt) is not None
+
+
+def test_thread_args_split_between_processes(replay):
+    outputVideo = make_output("a.webm")
+    inputVideo = outputVideo.inputVideos[0]
+
+    set_job([0, 1, 2, 3])
+    assert "-threads 4 " in replay.get_thread_args(outputVideo, inputVideo) + " "
+    assert "-threads 1 " in replay.get_thread_args(outputVideo, inputVideo, 4) + " "
+
+    set_job([0, 1, 2, 3], parallel=2)
+    assert "-threads 2 " in replay.get_thread_args(outputVideo, inputVideo) + " "
+
+
+def test_concat_script_uses_file_urls(replay, tmp_path):
+    clips = [str(tmp_path / "0__input__0.webm"), "relative/it's.webm"]
+    script = replay.gen_concat_script(clips, [1.5, 2.0])
+
+    lines = script.splitlines()
+    assert lines[0] == "ffconcat version 1.0"
+    assert lines[1] == f"file 'file:{clips[0]}'"
+    assert lines[2] == "duration 1.5"
+    assert lines[3] == "file 'file:" + os.path.abspath("relative/it's.webm").replace("'", "'\\''") + "'"
+
+    # ffmpeg opens the script from stdin as pipe: or fd: depending on the version
+    assert "file,pipe,fd" in replay.CONCAT_INPUT
+
+
+def test_released_shared_clips_get_encoded_again(replay):
+    outputs = [make_output("a.webm"), make_output("b.webm")]
+    inputVideo = outputs[0].inputVideos[0]
+    bitrate = outputs[0].calc_target_bitrate()[0]
+    _, cmd = replay.gen_encode_cmd(outputs[0], inputVideo, 0, "", inputVideo.timeRanges[0], 0, bitrate)
+
+    replay.SEGMENT_PLANNER.plan(outputs)
+    segment = replay.SEGMENT_PLANNER.get_shared(cmd, ".webm")
+    with open(segment.path, mode="wb") as file:
+        file.write(b"clip")
+    segment.encoded = True
+
+    for outputVideo in outputs:
+        replay.SEGMENT_PLANNER.release_output(outputVideo)
+
+    assert not os.path.isfile(segment.path)
+
+    # like the next pass in watch mode
+    replay.SEGMENT_PLANNER.plan(outputs)
+    segment = replay.SEGMENT_PLANNER.get_shared(cmd, ".webm")
+    assert segment is not None and not segment.encoded
+
+
+def test_normal_and_raw_outputs_released_separately(replay):
+    outputs = [make_output("a.webm"), make_output("a.webm", raw=True),
+               make_output("b.webm"), make_output("b.webm", raw=True)]
+    replay.SEGMENT_PLANNER.plan(outputs)
+
+    def get_segment(outputVideo):
+        inputVideo = outputVideo.inputVideos[0]
+        if outputVideo.raw:
+            _, cmd = replay.gen_common_cmd(outputVideo, inputVideo, 0, "", inputVideo.timeRanges[0], 0)
+            return replay.SEGMENT_PLANNER.get_shared(cmd, outputVideo.videoExtRaw)
+        bitrate = outputVideo.calc_target_bitrate()[0]
+        _, cmd = replay.gen_encode_cmd(outputVideo, inputVideo, 0, "", inputVideo.timeRanges[0], 0, bitrate)
+        return replay.SEGMENT_PLANNER.get_shared(cmd, outputVideo.videoExt)
+
+    normal, raw = get_segment(outputs[0]), get_segment(outputs[1])
+    assert normal is not raw
+    assert (normal.refCount, raw.refCount) == (2, 2)
+
+    # releasing the normal output leaves the raw output's clips alone
+    replay.SEGMENT_PLANNER.release_output(outputs[0])
+    assert (normal.refCount, raw.refCount) == (1, 2)
+    assert get_segment(outputs[1]) is raw
+
+    replay.SEGMENT_PLANNER.release_output(outputs[1])
+    assert (normal.refCount, raw.refCount) == (1, 1)
+
+
+def test_companion_leaves_shared_raw_clips_out(replay, tmp_path):
+    rawOutputs = [make_output("a.webm", raw=True), make_output("b.webm", raw=True),
+                  make_output("c.webm", ranges=(("0:01:00", "0:01:30"),), raw=True)]
+    replay.SEGMENT_PLANNER.plan(rawOutputs)
+
+    # the shared clip is written by the raw output's own encode, under the clip's lock
+    companion = replay.RawCompanion(rawOutputs[0], f"{tmp_path}{os.sep}")
+    inputVideo = rawOutputs[0].inputVideos[0]
+    assert companion.take(inputVideo, inputVideo.timeRanges[0]) == []
+    assert not companion.has_clip(0, 0)
+
+    companion = replay.RawCompanion(rawOutputs[2], f"{tmp_path}{os.sep}")
+    inputVideo = rawOutputs[2].inputVideos[0]
+    assert companion.take(inputVideo, inputVideo.timeRanges[0]) != []
+
+
+@pytest.mark.parametrize("success", [False, True])
+def test_first_pass_log_cached_only_on_success(replay, monkeypatch, tmp_path, success):
+    monkeypatch.setattr(replay, "CACHE_FOLDER", f"{tmp_path}{os.sep}cache{os.sep}")
+
+    # ffmpeg writes the stats frame by frame, a failed run leaves part of a log behind
+    def run_ffmpeg(outFile, cmd, progress=None, stdinText=None):
+        with open(outFile, mode="w", encoding="utf-8") as file:
+            file.write("partial")
+        return success
+
+    monkeypatch.setattr(replay, "run_ffmpeg", run_ffmpeg)
+
+    inputPath = tmp_path / "input.mkv"
+    inputPath.write_bytes(b"video")
+    outputVideo = make_output("a.webm", inputPath=str(inputPath))
+    inputVideo = outputVideo.inputVideos[0]
+    timeRange = inputVideo.timeRanges[0]
+    passLog = replay.get_pass_log(outputVideo, inputVideo, timeRange)
+
+    assert replay.run_first_pass(outputVideo, inputVideo, 0, "", timeRange, 0) == success
+    assert os.path.isfile(passLog + "-0.log") == success
+    assert os.listdir(os.path.dirname(passLog)) == ([os.path.basename(passLog) + "-0.log"] if success else [])
+
+
+def test_verify_catches_missing_time_range(replay, monkeypatch):
+    outputVideo = make_output("a.webm", ranges=(("0:00:10", "0:00:40"), ("0:01:00", "0:01:30")))
+    finished = []
+
+    # only the first time range made it into the output
+    monkeypatch.setattr(replay, "probe_streams",
+                        lambda path, countPackets=False: (30.0, [{"codec_type": "video", "nb_read_packets": "1800"}]))
+    monkeypatch.setattr(replay, "finish_output_video", finished.append)
+
+    verifier = replay.OutputVerifier()
+    verifier.submit(outputVideo)
+
+    assert verifier.wait() == [outputVideo]
+    assert finished == []
+    verifier.shutdown()
+
+
+@pytest.mark.parametrize("packets, reason", [("3600", ""), ("1800", "frames")])
+def test_verify_counts_video_frames(replay, monkeypatch, packets, reason):
+    outputVideo = make_output("a.webm", ranges=(("0:00:00", "0:01:00"),))
+
+    # the audio keeps the container at full length, the video stopped halfway
+    streams = [{"codec_type": "video", "avg_frame_rate": "60/1", "nb_read_packets": packets},
+               {"codec_type": "audio", "avg_frame_rate": "0/0", "nb_read_packets": "2800"}]
+    monkeypatch.setattr(replay, "probe_streams", lambda path, countPackets=False: (60.0, streams))
+
+    assert reason in replay.OutputVerifier.check(outputVideo, 60.0, 1)
+    assert bool(replay.OutputVerifier.check(outputVideo, 60.0, 1)) == bool(reason)
+
+
+def test_failed_output_invalidates_shared_clips(replay):
+    outputs = [make_output("a.webm"), make_output("b.webm"), make_output("c.webm")]
+    inputVideo = outputs[0].inputVideos[0]
+    bitrate = outputs[0].calc_target_bitrate()[0]
+    _, cmd = replay.gen_encode_cmd(outputs[0], inputVideo, 0, "", inputVideo.timeRanges[0], 0, bitrate)
+
+    replay.SEGMENT_PLANNER.plan(outputs)
+    segment = replay.SEGMENT_PLANNER.get_shared(cmd, ".webm")
+    with open(segment.path, mode="wb") as file:
+        file.write(b"broken clip")
+    segment.encoded = True
+
+    replay.SEGMENT_PLANNER.release_output(outputs[0])
+    replay.SEGMENT_PLANNER.invalidate_output(outputs[0])
+
+    # the other outputs still share it, but don't reuse what the failed output was made from
+    assert not segment.encoded and not os.path.isfile(segment.path)
+    assert replay.SEGMENT_PLANNER.get_shared(cmd, ".webm") is segment
+
+
+@pytest.mark.parametrize("change", [
+    lambda outputVideo: setattr(outputVideo, "targetSize", 4000),
+    lambda outputVideo: setattr(outputVideo.inputVideos[0], "audioBitrate", 96),
+    lambda outputVideo: outputVideo.inputVideos[0].cmdPass1.append("-deadline good"),
+    lambda outputVideo: outputVideo.inputVideos[0].cmdPass2.append("-cpu-used 2"),
+    lambda outputVideo: outputVideo.markers.append(["kill", 1, 2]),
+    lambda outputVideo: setattr(outputVideo, "videoExt", ".mp4"),
+    lambda outputVideo: setattr(outputVideo, "sizeTargets", [(10, 25)]),
+])
+def test_watch_sees_every_block_setting(replay, change):
+    outputVideo = make_output("a.webm")
+    definition = outputVideo.get_definition()
+
+    change(outputVideo)
+    assert outputVideo.get_definition() != definition
+
+
+def test_failed_scene_index_not_cached(replay, monkeypatch, tmp_path):
+    inputPath = tmp_path / "input.mkv"
+    inputPath.write_bytes(b"video")
+    monkeypatch.setattr(replay, "SOURCE_CACHE_FOLDER", f"{tmp_path}{os.sep}sources{os.sep}")
+
+    # interrupted partway through, after printing one cut
+    failed = replay.subprocess.CompletedProcess("", 255, None, "[Parsed_showinfo_1] n: 0 pts_time:4.5 pos:1\n")
+    monkeypatch.setattr(replay.subprocess, "run", lambda *args, **kwargs: failed)
+
+    indexer = replay.SceneIndexer()
+    assert indexer.index_video(str(inputPath)) is None
+    assert not os.path.isfile(indexer.get_cache_path(str(inputPath)))
+
+
+def test_scratch_only_reserves_what_is_not_written_yet(replay, tmp_path):
+    root = replay.SCRATCH.reserve("job", 1000)
+    os.makedirs(root + "job")
+    with open(os.path.join(root, "job", "clip.webm"), mode="wb") as file:
+        file.write(b"0" * 400)
+
+    # the 400 written bytes already came out of the disk's free space
+    assert replay.SCRATCH.get_reserved(root) == 600
+
+    replay.SCRATCH.release("job")
+    assert replay.SCRATCH.get_reserved(root) == 0
+
+
+def test_raw_reservation_released_when_encode_throws(replay, monkeypatch):
+    ignore = lambda *args: None
+    monkeypatch.setattr(replay, "SPEED_HISTORY", types.SimpleNamespace(get_cost=lambda output: 1), raising=False)
+    monkeypatch.setattr(replay, "MEMORY_HISTORY", types.SimpleNamespace(get_memory=lambda output: 0, add=ignore),
+                        raising=False)
+    monkeypatch.setattr(replay, "PREFETCHER", types.SimpleNamespace(job_started=ignore, job_finished=ignore),
+                        raising=False)
+    monkeypatch.setattr(replay, "DASHBOARD", types.SimpleNamespace(job_done=ignore), raising=False)
+    monkeypatch.setattr(replay, "RawCompanion", lambda rawOutput, tempFolder: None)
+
+    def encode_output_video(outputVideo, tempFolder, companion=None):
+        raise RuntimeError("ffmpeg went away")
+
+    monkeypatch.setattr(replay, "encode_output_video", encode_output_video)
+
+    job = replay.EncodeJob(0, make_output("a.webm"), make_output("a.webm", raw=True))
+    job.run()
+
+    assert replay.SCRATCH.reservations == {}
+
+
+@pytest.mark.parametrize("freeMB, reason", [(100000, ""), (2100, "scratch space")])
+def test_admission_holds_jobs_without_scratch_space(replay, monkeypatch, freeMB, reason):
+    monkeypatch.setattr(replay.ARGS, "max_load", 0)
+    monkeypatch.setattr(replay.psutil, "virtual_memory", lambda: types.SimpleNamespace(available=64 << 30),
+                        raising=False)
+    monkeypatch.setattr(replay.SCRATCH, "get_most_free_space", lambda: freeMB * replay.BYTES_PER_MB)
+    monkeypatch.setattr(replay, "estimate_temp_size", lambda output: 100 * replay.BYTES_PER_MB)
+
+    job = types.SimpleNamespace(memory=0, outputs=[make_output("a.webm")])
+    result = replay.AdmissionControl().check(job, [])
+    assert reason in result and bool(result) == bool(reason)
+
+
+def test_clips_aborted_before_giving_up_get_finished(replay, monkeypatch, tmp_path):
+    outputVideo = make_output("a.webm")
+    inputVideo = outputVideo.inputVideos[0]
+    monkeypatch.setattr(outputVideo, "use_split_audio", lambda: False)
+    finished = []
+
+    # every attempt lands way over the size and gets aborted, until the size loop gives up on the same size twice
+    def run_ffmpeg_segment(outputName, cmd, ext, extraOutputs=None, progress=None, threadArgs=""):
+        if progress.sizeWindow:
+            progress.aborted = True
+            progress.totalSize = 100 * replay.BYTES_PER_MB
+            progress.bitrate = 20000.0
+            return outputName, False
+
+        finished.append(outputName)
+        with open(outputName, mode="wb") as file:
+            file.write(b"clip")
+        return outputName, True
+
+    monkeypatch.setattr(replay, "run_ffmpeg_segment", run_ffmpeg_segment)
+
+    subVideos = replay.encode_input_videos(outputVideo, inputVideo, 0, f"{tmp_path}{os.sep}")
+    assert subVideos == finished and all(subVideos)
+
+
+def test_audio_clip_ignores_an(replay, monkeypatch):
+    outputVideo = make_output("a.webm")
+    inputVideo = outputVideo.inputVideos[0]
+    inputVideo.cmd.append("-c:v libvpx-vp9 -an -c:a libopus")
+    cmds = []
+
+    monkeypatch.setattr(replay, "run_ffmpeg", lambda outFile, cmd: cmds.append(" ".join(cmd)) or False)
+    replay.encode_audio_clip(outputVideo, inputVideo, inputVideo.timeRanges[0])
+
+    assert " -an " not in cmds[0] + " " and "-c:a libopus" in cmds[0]
+
+
+@pytest.mark.parametrize("targets", [("25", "10"), ("10 25", "10 50")])
+def test_size_target_changes_hash(replay, targets):
+    hashLists = []
+    for value in targets:
+        outputVideo = make_output("a.webm")
+        outputVideo.sizeTargets = replay.parse_size_targets(value)
+        hashLists.append([rendition.hashList for rendition in outputVideo.create_renditions()][-1])
+
+    assert hashLists[0] != hashLists[1]
+
+
+def test_ladder_calibrates_on_the_first_size(replay, monkeypatch):
+    outputVideo = make_output("a.webm")
+    outputVideo.sizeTargets = replay.parse_size_targets("10 25 50")
+    renditions = outputVideo.create_renditions()
+    assert len({rendition.videoPath for rendition in renditions}) == 3
+
+    job = types.SimpleNamespace(cpus=[0, 1, 2, 3], parallel=1, cancelled=replay.threading.Event())
+    replay.JOB_STATE.job = job
+    encoded = []
+
+    # the rest run at once and share the job's cpus, the first one has them to itself
+    def encode_output_video(rendition, tempFolder, companion=None):
+        encoded.append((rendition, replay.get_job().parallel))
+
+    monkeypatch.setattr(replay, "encode_output_video", encode_output_video)
+    replay.encode_size_ladder(outputVideo.ladder)
+
+    assert encoded[0] == (renditions[0], 1)
+    assert sorted(parallel for _, parallel in encoded[1:]) == [2, 2]
+    assert job.parallel == 1
+